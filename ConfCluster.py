@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:40:12 2026
+
+@author: ke291
+
+Clustering of conformer ensembles in torsion space. Used by
+Gaussian.SetupGaussianCluster to pick the lowest energy conformer of every
+cluster for the DFT calculations.
+"""
+
+import numpy
+
+#Number of rows of a distance matrix computed at once by KMedoids
+DistanceBlockSize = 1024
+
+
+"""
+Clusters the conformers on their torsion angles, a (nconf, ntors) array in
+degrees, and picks the lowest energy member of every cluster.
+
+settings.ClusterMethod selects the algorithm:
+'hdbscan' - HDBSCAN with clusters of at least settings.ClusterMinSize
+            conformers, needs the hdbscan package, unclustered conformers
+            are labelled -1 and treated as one more cluster
+'leader'  - LeaderClusters with radius settings.ClusterRadius
+'kmedoids' - KMedoids with settings.ClusterCount clusters, or with
+            settings.PerStructConfLimit clusters if that is 0
+
+Returns the cluster label of every conformer and the indices of the
+lowest energy conformers of the clusters, in the order of their labels.
+"""
+def ClusterConformers(torsions, energies, settings):
+
+    features = TorsionFeatures(torsions)
+    energies = numpy.asarray(energies, dtype=numpy.float64)
+
+    if settings.ClusterMethod == 'leader':
+        labels = LeaderClusters(features, energies, settings.ClusterRadius)
+    elif settings.ClusterMethod == 'kmedoids':
+        if settings.ClusterCount > 0:
+            k = settings.ClusterCount
+        else:
+            k = settings.PerStructConfLimit
+        labels = KMedoids(features, energies, k)
+    else:
+        import hdbscan
+        clusterer = hdbscan.HDBSCAN(min_cluster_size=settings.ClusterMinSize,
+                                    min_samples=1)
+        clusterer.fit(features)
+        labels = numpy.asarray(clusterer.labels_)
+
+    return labels, ClusterMinima(labels, energies)
+
+
+#Torsions as points on circles, (sin, cos) pairs, so that -179 and 179
+#degrees are as close as 1 and -1
+def TorsionFeatures(torsions):
+
+    angles = numpy.radians(numpy.asarray(torsions, dtype=numpy.float64))
+    if angles.ndim == 1:
+        angles = angles[:, None]
+
+    return numpy.hstack([numpy.sin(angles), numpy.cos(angles)])
+
+
+#Index of the lowest energy conformer of every cluster, in label order
+def ClusterMinima(labels, energies):
+
+    order = numpy.lexsort((energies, labels))
+    firsts = numpy.unique(labels[order], return_index=True)[1]
+
+    return order[firsts]
+
+
+#Members of every cluster, in label order
+def ClusterMembers(labels):
+
+    order = numpy.argsort(labels, kind='mergesort')
+    firsts = numpy.unique(labels[order], return_index=True)[1]
+
+    return numpy.split(order, firsts[1:])
+
+
+#Euclidean distances between the rows of A and the rows of B
+def FeatureDistances(A, B):
+
+    d2 = (A**2).sum(axis=1)[:, None] + (B**2).sum(axis=1)[None, :] - \
+        2.0*numpy.dot(A, B.T)
+
+    return numpy.sqrt(numpy.maximum(d2, 0.0))
+
+
+"""
+Leader clustering. The conformers are visited in ascending energy and join
+the nearest existing leader within radius, otherwise they become a new
+leader. Every cluster is represented by its leader, which is its lowest
+energy member. For torsion features a radius of 1 allows one torsion to
+differ by 60 degrees.
+"""
+def LeaderClusters(features, energies, radius):
+
+    labels = numpy.empty(len(features), dtype=int)
+    Leaders = numpy.empty(features.shape)
+    nleaders = 0
+
+    for c in numpy.argsort(energies, kind='mergesort'):
+        if nleaders > 0:
+            dists = FeatureDistances(features[c:c+1], Leaders[:nleaders])[0]
+            nearest = dists.argmin()
+            if dists[nearest] < radius:
+                labels[c] = nearest
+                continue
+        Leaders[nleaders] = features[c]
+        labels[c] = nleaders
+        nleaders += 1
+
+    return labels
+
+
+"""
+K-medoids clustering by alternating assignment and medoid update. The first
+medoid is the lowest energy conformer and every next one the conformer
+farthest from the medoids so far. Conformers are then assigned to their
+nearest medoid and every medoid is moved to the member with the smallest
+summed distance to the rest of its cluster, until the medoids stay put.
+"""
+def KMedoids(features, energies, k, maxiter=100):
+
+    k = max(1, min(k, len(features)))
+
+    Medoids = [int(numpy.argmin(energies))]
+    MinDists = FeatureDistances(features, features[Medoids])[:, 0]
+    while len(Medoids) < k:
+        Medoids.append(int(MinDists.argmax()))
+        MinDists = numpy.minimum(MinDists, FeatureDistances(
+            features, features[Medoids[-1]:Medoids[-1]+1])[:, 0])
+    Medoids = numpy.array(Medoids)
+
+    for i in range(maxiter):
+        labels = FeatureDistances(features, features[Medoids]).argmin(axis=1)
+        NewMedoids = Medoids.copy()
+        for members in ClusterMembers(labels):
+            NewMedoids[labels[members[0]]] = Medoid(features, members)
+        if numpy.array_equal(NewMedoids, Medoids):
+            break
+        Medoids = NewMedoids
+
+    return FeatureDistances(features, features[Medoids]).argmin(axis=1)
+
+
+#Member of the cluster with the smallest summed distance to the others,
+#the distances are computed DistanceBlockSize rows at a time
+def Medoid(features, members):
+
+    X = features[members]
+    costs = numpy.empty(len(members))
+    for start in range(0, len(members), DistanceBlockSize):
+        costs[start:start+DistanceBlockSize] = FeatureDistances(
+            X[start:start+DistanceBlockSize], X).sum(axis=1)
+
+    return members[costs.argmin()]
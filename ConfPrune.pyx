@@ -9,126 +9,926 @@ and NWChem.py
 """
 
 from math import sqrt
-from libc.stdlib cimport malloc, free
+import os
+import tempfile
+import numpy
+
+#Number of conformer pairs aligned per vectorized block
+cdef long int PairBlockSize = 65536
+#Number of kept conformers compared at once in leader pruning,
+#small enough for the first match to end the comparisons early
+cdef long int LeaderBlockSize = 32
+#Resolution of the uint16 RMSD encoding in angstrom, max 65.535 A
+cdef double FixedPointStep = 0.001
+#Number of prefiltered pairs gathered and aligned at once
+cdef long int PairChunkSize = 8192
+#Margin on the lower bounds against rounding, in angstrom
+cdef double BoundSlack = 1e-6
+#Relative precision and iteration limit of the QCP eigenvalue search
+cdef double QCPPrecision = 1e-11
+cdef int QCPMaxIter = 50
+#Heavy atoms whose hydrogens are kept by the polarH atom subset
+PolarHosts = ('N', 'O', 'S')
+
+
+#Defaults used when the prune functions are called without PyDP4 settings
+class PruneDefaults:
+    PruneMode = 'greedy'
+    PruneProc = 1
+    RMSDEncoding = 'float64'
+    RMSDMemoryLimit = 2000
+    RMSDPrefilter = True
+    RMSDAtoms = 'all'
+    RMSDMassWeight = False
+
+
 """
-Main function of this file. Takes an array of [x, y, z] for each molecule,
-as well as a list of atom symbols in the same order as their coordinates
+Main functions of this file. Take a list of conformers, each an array of
+[atomnum, x, y, z] for every atom, as well as a list of atom symbols in the
+same order as their coordinates.
+
+The all-pairs RMSD matrix is computed for the whole ensemble at once by
+RMSDMatrix, then walked greedily, deleting every conformer that is closer
+than the cutoff to an earlier, non-deleted conformer.
+
+If cachefile is given, the RMSD matrix is read from it when it matches the
+ensemble, otherwise it is computed and saved there for later calls.
+
+The PyDP4 settings select the pruning mode (with PruneMode 'leader'
+RMSDPrune uses LeaderPrune and never builds the matrix), the atoms used for
+the alignment and their weights (see PruneCoords), the number of processes
+computing the matrix and how the matrix is stored.
 
-Translates both molecules to origin, gets the rotation matrix from quatfit
-and rotates the second molecule to align with the first
+With RMSDPrefilter RMSDPrune only aligns the pairs whose lower bound (see
+LowerBounds) is below the cutoff. The other pairs can never be within the
+cutoff, so the pruning is unchanged, but the matrix then only holds the
+bounds for them and is not written to the cache.
 """
-def RMSDPrune(conformers, atoms, cutoff):
-    
-    ToDel = []
-    cdef long int c1, c2, c
-    cdef long int l = len(conformers)
-    cdef double res
-    cdef double *RMSDMatrix = <double *>malloc(l * l * sizeof(double))
-    
-    for c1 in range(0, l):
-        for c2 in range(c1, l):
-            if c1==c2:
-                RMSDMatrix[c2 + c1*l]=0.0
-            else:
-                res = AlignedRMS(conformers[c1], conformers[c2], atoms)
-                RMSDMatrix[c2 + c1*l] = res
-                RMSDMatrix[c1 + c2*l] = res
-    #Check for similar conformations
-    for c1 in range(0, l):
-        for c2 in range(0, l):
-            if c1!=c2 and (not c1 in ToDel) and (not c2 in ToDel):
-                #if Align.AlignedRMS(conformers[c1], conformers[c2], atoms) < cutoff:
-                #    ToDel.append(c2)
-                if RMSDMatrix[c2 + c1*l]<cutoff:
-                    ToDel.append(c2)
+def RMSDPrune(conformers, atoms, cutoff, cachefile='', settings=None):
+
+    if settings is None:
+        settings = PruneDefaults()
+
+    if settings.PruneMode == 'leader':
+        return LeaderPrune(conformers, atoms, cutoff, settings)
+
+    if settings.RMSDPrefilter:
+        RMSDs = RMSDMatrix(conformers, atoms, cachefile, settings, cutoff)
+    else:
+        RMSDs = RMSDMatrix(conformers, atoms, cachefile, settings)
     
     #Compose set of non-redundant conformations
-    PrunedConformers = []
-    for c in range(0, l):
-        if not c in ToDel:
-            PrunedConformers.append(conformers[c])
-            
-    #return PrunedConformers
-    free(RMSDMatrix)
-    return PrunedConformers
-
-def AdaptRMSDPrune(conformers, atoms, cutoff, ConfLimit):
-    
-    ToDel = []
-    cdef long int c1, c2
-    cdef long int l = len(conformers)
-    cdef double res
-    cdef double *RMSDMatrix = <double *>malloc(l * l * sizeof(double))
-    
-    for c1 in range(0, l):
-        for c2 in range(c1, l):
-            if c1==c2:
-                RMSDMatrix[c2 + c1*l]=0.0
-            else:
-                res = AlignedRMS(conformers[c1], conformers[c2], atoms)
-                RMSDMatrix[c2 + c1*l] = res
-                RMSDMatrix[c1 + c2*l] = res
-    #Check for similar conformations
-    for c1 in range(0, l):
-        for c2 in range(0, l):
-            if c1!=c2 and (not c1 in ToDel) and (not c2 in ToDel):
-                if RMSDMatrix[c2 + c1*l]<cutoff:
-                    ToDel.append(c2)
-    AdjCutoff = cutoff
-    while (l-len(ToDel))>ConfLimit:
-        AdjCutoff +=0.2
-        ToDel = []
-        for c1 in range(0, l):
-            for c2 in range(0, l):
-                if c1!=c2 and (not c1 in ToDel) and (not c2 in ToDel):
-                    if RMSDMatrix[c2 + c1*l]<AdjCutoff:
-                        ToDel.append(c2)
-              
-    #return PrunedConformers
-    free(RMSDMatrix)
+    return [conformers[c] for c in GreedyPrune(RMSDs, cutoff)]
+
+
+def AdaptRMSDPrune(conformers, atoms, cutoff, ConfLimit, cachefile='',
+                   settings=None):
+
+    RMSDs = RMSDMatrix(conformers, atoms, cachefile, settings)
+
+    AdjCutoff, Kept = CutoffSearch(RMSDs, cutoff, ConfLimit)
+
     return AdjCutoff
 
 
-def StrictRMSDPrune(conformers, atoms, cutoff, ConfLimit):
-    
-    ToDel = []
-    cdef long int c1, c2
+def StrictRMSDPrune(conformers, atoms, cutoff, ConfLimit, cachefile='',
+                    settings=None):
+
+    RMSDs = RMSDMatrix(conformers, atoms, cachefile, settings)
+
+    AdjCutoff, Kept = CutoffSearch(RMSDs, cutoff, ConfLimit)
+
+    #Compose set of non-redundant conformations
+    return [conformers[c] for c in Kept], AdjCutoff
+
+
+"""
+Leader pruning. Visits the conformers in ascending MM energy and compares
+each one only with the conformers kept so far, stopping at the first one
+within the cutoff. The cost scales with the number of conformers times the
+number of kept conformers, and every kept conformer is the lowest energy
+member of its neighbourhood. Conformers without energies are visited in
+the given order, which for MM output is already ascending energy.
+
+With settings.RMSDPrefilter, kept conformers whose lower bound is already
+above the cutoff are skipped without aligning them.
+"""
+def LeaderPrune(conformers, atoms, cutoff, settings=None):
+
+    cdef long int c, k, nkept = 0
     cdef long int l = len(conformers)
-    cdef double res
-    cdef double *RMSDMatrix = <double *>malloc(l * l * sizeof(double))
-    
-    for c1 in range(0, l):
-        for c2 in range(c1, l):
-            if c1==c2:
-                RMSDMatrix[c2 + c1*l]=0.0
-            else:
-                res = AlignedRMS(conformers[c1], conformers[c2], atoms)
-                RMSDMatrix[c2 + c1*l] = res
-                RMSDMatrix[c1 + c2*l] = res
-    #Check for similar conformations
-    for c1 in range(0, l):
-        for c2 in range(0, l):
-            if c1!=c2 and (not c1 in ToDel) and (not c2 in ToDel):
-                if RMSDMatrix[c2 + c1*l]<cutoff:
-                    ToDel.append(c2)
-    AdjCutoff = cutoff
-    while (l-len(ToDel))>ConfLimit:
-        AdjCutoff +=0.2
-        ToDel = []
-        for c1 in range(0, l):
-            for c2 in range(0, l):
-                if c1!=c2 and (not c1 in ToDel) and (not c2 in ToDel):
-                    if RMSDMatrix[c2 + c1*l]<AdjCutoff:
-                        ToDel.append(c2)
+    cdef long int naligned = 0, nskipped = 0
+
+    if settings is None:
+        settings = PruneDefaults()
+    prefilter = settings.RMSDPrefilter
+
+    coords, w = PruneCoords(conformers, atoms, settings)
+    G = numpy.einsum('cak,a->c', coords**2, w)
+    if prefilter:
+        P = CentroidDistances(coords)
+
+    if hasattr(conformers, 'energies'):
+        order = numpy.argsort(conformers.energies, kind='mergesort')
+    else:
+        order = numpy.arange(l)
+
+    Kept = numpy.empty(l, dtype=numpy.intp)
+    for c in order:
+        similar = False
+        for k in range(0, nkept, LeaderBlockSize):
+            idx = Kept[k:min(k + LeaderBlockSize, nkept)]
+            if prefilter:
+                near = idx[LowerBounds(P[c:c+1], P[idx], w)[0] <
+                           cutoff + BoundSlack]
+                nskipped += len(idx) - len(near)
+                idx = near
+                if len(idx) == 0:
+                    continue
+            naligned += len(idx)
+            if (BlockRMSD(coords[c:c+1], coords[idx], w, G[c:c+1],
+                          G[idx]) < cutoff).any():
+                similar = True
+                break
+        if not similar:
+            Kept[nkept] = c
+            nkept += 1
+
+    print(str(naligned) + " alignments done by leader pruning instead of " +
+          str(l*(l-1)//2) + " for the full RMSD matrix")
+    if prefilter:
+        print(str(nskipped) + " alignments skipped by the lower bound prefilter")
+
     #Compose set of non-redundant conformations
-    PrunedConformers = []
-    for c in range(0, l):
-        if not c in ToDel:
-            PrunedConformers.append(conformers[c])
-            
-    #return PrunedConformers
-    free(RMSDMatrix)
-    return PrunedConformers, AdjCutoff
+    return [conformers[c] for c in numpy.sort(Kept[:nkept])]
+
+
+class StreamPruner:
+    """
+    Leader pruning of conformers that arrive one at a time, eg. while the
+    MM search is still writing them. Add compares a new conformer with the
+    conformers kept so far, in blocks as LeaderPrune does, so the kept set
+    is up to date after every conformer and available as soon as the
+    stream ends.
+
+    The stream does not have to be in ascending energy, eg. when a Rot5Cycle
+    search follows the main one. A new conformer within the cutoff of a kept
+    one replaces it if its energy is lower. A replacement is only compared
+    with the conformer it replaces, so Ensemble leader prunes the kept
+    conformers once more in ascending energy, leaving no two of them within
+    the cutoff. For a stream in ascending energy, as in a single MM output
+    file, nothing is replaced and the result is the same as that of
+    LeaderPrune.
+
+    With an energy window, conformers that are not within window of the
+    lowest energy seen so far are dropped, and Ensemble only returns the
+    kept conformers within window of the final lowest energy.
+    """
+
+    def __init__(self, atoms, cutoff, window=None, settings=None, charge=0):
+        if settings is None:
+            settings = PruneDefaults()
+        self.atoms = list(atoms)
+        self.cutoff = cutoff
+        self.window = window
+        self.settings = settings
+        self.charge = charge
+        self.SeenEs = []
+        self.MinE = float('inf')
+        self.nkept = 0
+        self.naligned = 0
+        self.nskipped = 0
+        self.idx = None
+
+    def __len__(self):
+        return self.nkept
+
+    #Adds a conformer with energy E and (natoms, 3) coordinates, returns
+    #True if it is kept
+    def Add(self, E, coords):
+
+        coords = numpy.asarray(coords, dtype=numpy.float64)
+        self.SeenEs.append(E)
+        self.MinE = min(self.MinE, E)
+        if self.window is not None and E >= self.MinE + self.window:
+            return False
+
+        if self.idx is None:
+            self.idx, self.w = AlignedAtoms(self.atoms, coords[None],
+                                            self.settings)
+            self.Allocate(64, coords.shape)
+
+        X = CenterCoords(coords[None, self.idx], self.w)
+        G = numpy.einsum('cak,a->c', X**2, self.w)
+        P = CentroidDistances(X)
+
+        k = self.Match(X, G, P)
+        if k < 0:
+            if self.nkept == len(self.Es):
+                self.Allocate(2*len(self.Es), coords.shape)
+            k = self.nkept
+            self.nkept += 1
+        elif E >= self.Es[k]:
+            return False
+
+        self.Coords[k] = coords
+        self.X[k] = X[0]
+        self.G[k] = G[0]
+        self.P[k] = P[0]
+        self.Es[k] = E
+
+        return True
+
+    #Adds every (energy, coordinates) pair of a stream
+    def Feed(self, stream):
+        for E, coords in stream:
+            self.Add(E, coords)
+
+    #Index of the first kept conformer within the cutoff of the centered
+    #conformer X, -1 if there is none. If kept is given, only the kept
+    #conformers with these indices are compared
+    def Match(self, X, G, P, kept=None):
+
+        cdef long int k
+
+        if kept is None:
+            kept = numpy.arange(self.nkept)
+
+        for k in range(0, len(kept), LeaderBlockSize):
+            idx = kept[k:k + LeaderBlockSize]
+            if self.settings.RMSDPrefilter:
+                near = idx[LowerBounds(P, self.P[idx], self.w)[0] <
+                           self.cutoff + BoundSlack]
+                self.nskipped += len(idx) - len(near)
+                idx = near
+                if len(idx) == 0:
+                    continue
+            self.naligned += len(idx)
+            hits = numpy.nonzero(BlockRMSD(X, self.X[idx], self.w, G,
+                                           self.G[idx])[0] < self.cutoff)[0]
+            if len(hits) > 0:
+                return idx[hits[0]]
+
+        return -1
+
+    #Grows the arrays of the kept conformers to hold size conformers
+    def Allocate(self, size, shape):
+
+        n = self.nkept
+        Arrays = [('Coords', (size,) + shape), ('X', (size, len(self.idx), 3)),
+                  ('G', (size,)), ('P', (size, len(self.idx))),
+                  ('Es', (size,))]
+        for name, ashape in Arrays:
+            new = numpy.empty(ashape, dtype=numpy.float64)
+            if n > 0:
+                new[:n] = getattr(self, name)[:n]
+            setattr(self, name, new)
+
+    #Number of conformers seen within the final energy window
+    def Seen(self):
+
+        SeenEs = numpy.array(self.SeenEs)
+        if self.window is None:
+            return len(SeenEs)
+
+        return int((SeenEs < self.MinE + self.window).sum())
+
+    #The kept conformers within the energy window in ascending energy
+    def Ensemble(self, dtype=numpy.float64):
+
+        import Conformers
+
+        kept = numpy.arange(self.nkept)
+        if self.window is not None:
+            kept = kept[self.Es[:self.nkept] < self.MinE + self.window]
+        kept = kept[numpy.argsort(self.Es[kept], kind='mergesort')]
+
+        Leaders = numpy.empty(len(kept), dtype=numpy.intp)
+        nleaders = 0
+        for c in kept:
+            if self.Match(self.X[c:c+1], self.G[c:c+1], self.P[c:c+1],
+                          Leaders[:nleaders]) < 0:
+                Leaders[nleaders] = c
+                nleaders += 1
+        kept = Leaders[:nleaders]
+
+        print(str(self.naligned) + " alignments done by stream pruning of " +
+              str(len(self.SeenEs)) + " conformers")
+        if self.settings.RMSDPrefilter:
+            print(str(self.nskipped) +
+                  " alignments skipped by the lower bound prefilter")
+
+        if self.idx is None:
+            return Conformers.Ensemble(self.atoms,
+                                       numpy.zeros((0, len(self.atoms), 3)),
+                                       self.charge, None, dtype)
+
+        return Conformers.Ensemble(self.atoms, self.Coords[kept], self.charge,
+                                   self.Es[kept], dtype)
+
+
+#Walks the RMSD matrix in conformer order and returns the indices of
+#the conformers that have no earlier kept conformer within the cutoff
+def GreedyPrune(RMSDs, cutoff):
+
+    cdef long int c1
+    cdef long int l = len(RMSDs)
+    Keep = numpy.ones(l, dtype=bool)
+
+    for c1 in range(0, l-1):
+        if Keep[c1]:
+            Keep[c1+1:] &= RMSDs.Row(c1) >= cutoff
+
+    return numpy.nonzero(Keep)[0]
+
+
+"""
+Finds a cutoff, not below the given one, at which greedy pruning keeps at
+most ConfLimit conformers. The number of kept conformers can only change
+when the cutoff passes one of the pairwise RMSDs, so the candidate cutoffs
+are the sorted distinct RMSDs (each nudged up to the next float, as pairs
+closer than the cutoff are pruned), and these are bisected.
+
+To keep the candidate list small the answer is first bracketed with
+doubling steps of 0.2 A, and only the RMSDs inside the bracket are sorted.
+The bracketing and the bisection treat the number of kept conformers as
+falling with the cutoff. Greedy pruning does not guarantee that, so the
+candidates below the bisection result are then walked downward, see
+LowerCutoff. Returns the cutoff and the indices of the conformers kept
+at it.
+"""
+def CutoffSearch(RMSDs, cutoff, ConfLimit):
+
+    cdef long int lo, hi, mid
+
+    Kept = GreedyPrune(RMSDs, cutoff)
+    if len(Kept) <= ConfLimit or len(RMSDs) < 2:
+        return cutoff, Kept
+
+    LowCutoff = cutoff
+    step = 0.2
+    HighCutoff = cutoff + step
+    Kept = GreedyPrune(RMSDs, HighCutoff)
+    while len(Kept) > ConfLimit:
+        LowCutoff = HighCutoff
+        step *= 2
+        HighCutoff = cutoff + step
+        Kept = GreedyPrune(RMSDs, HighCutoff)
+
+    cutoffs = numpy.union1d(
+        numpy.nextafter(RMSDs.Between(LowCutoff, HighCutoff), numpy.inf),
+        [HighCutoff])
+
+    #The largest candidate is the top of the bracket, known to be enough
+    lo = 0
+    hi = len(cutoffs) - 1
+    while lo < hi:
+        mid = (lo + hi)//2
+        MidKept = GreedyPrune(RMSDs, cutoffs[mid])
+        if len(MidKept) <= ConfLimit:
+            hi = mid
+            Kept = MidKept
+        else:
+            lo = mid + 1
+
+    return LowerCutoff(RMSDs, cutoff, float(cutoffs[hi]), Kept, ConfLimit)
+
+
+"""
+Walks the candidate cutoffs from high down to low, where greedy pruning
+keeps Kept, and returns the smallest one at which at most ConfLimit
+conformers are kept, with the indices of those conformers.
+
+Moving the cutoff below an RMSD only changes the kept set if the first
+conformer of the pair is kept and the second is not, as otherwise the pair
+prunes nothing. The greedy sweep is only redone for those candidates.
+"""
+def LowerCutoff(RMSDs, low, high, Kept, ConfLimit):
+
+    cdef long int k
+
+    pairs, values = RMSDs.Pairs(low, high)
+    order = numpy.argsort(values, kind='mergesort')[::-1]
+    pairs = pairs[order]
+    values = values[order]
+    starts = numpy.array([CondensedIndex(k, len(RMSDs))
+                          for k in range(len(RMSDs))])
+    c1s = numpy.searchsorted(starts, pairs, side='right') - 1
+    c2s = pairs - starts[c1s] + c1s + 1
+
+    Keep = numpy.zeros(len(RMSDs), dtype=bool)
+    Keep[Kept] = True
+    BestCutoff = high
+    #Groups of equal RMSDs in descending order, the cutoff just above the
+    #next group is the next candidate
+    firsts = numpy.nonzero(numpy.r_[True, values[1:] != values[:-1]])[0]
+    for k in range(len(firsts) - 1):
+        group = slice(firsts[k], firsts[k+1])
+        candidate = float(numpy.nextafter(values[firsts[k+1]], numpy.inf))
+        if (Keep[c1s[group]] & ~Keep[c2s[group]]).any():
+            Keep[:] = False
+            Keep[GreedyPrune(RMSDs, candidate)] = True
+        if Keep.sum() <= ConfLimit:
+            BestCutoff = candidate
+            Kept = numpy.nonzero(Keep)[0]
+
+    return BestCutoff, Kept
+
+
+#Returns the conformer coordinates as a (nconf, natoms, 3) float array,
+#only text conformers have to be converted
+def GetCoordArray(conformers):
+
+    if hasattr(conformers, 'coords'):
+        return numpy.asarray(conformers.coords, dtype=numpy.float64)
+
+    return numpy.array([[[float(x) for x in a[1:4]] for a in conf]
+                        for conf in conformers], dtype=numpy.float64)
+
+
+"""
+Selects the atoms used for the alignment with settings.RMSDAtoms, 'all',
+'heavy' for the heavy atoms only or 'polarH' for the heavy atoms and the
+hydrogens on N, O and S. A hydrogen belongs to the heavy atom closest to
+it in the first conformer. The atoms are weighted by their mass if
+settings.RMSDMassWeight is set, otherwise equally.
+Returns the indices of the selected atoms and their weights.
+"""
+def AlignedAtoms(atoms, coords, settings):
+
+    atoms = [a.strip() for a in atoms]
+    heavy = numpy.array([a != 'H' for a in atoms], dtype=bool)
+
+    if settings.RMSDAtoms == 'heavy':
+        selected = heavy
+    elif settings.RMSDAtoms == 'polarH':
+        selected = heavy.copy()
+        Hs = numpy.nonzero(~heavy)[0]
+        Hosts = numpy.nonzero(heavy)[0]
+        if len(Hs) > 0 and len(Hosts) > 0:
+            dists = ((coords[0][Hs][:, None, :] -
+                      coords[0][Hosts][None, :, :])**2).sum(axis=2)
+            selected[Hs] = [atoms[h] in PolarHosts
+                            for h in Hosts[dists.argmin(axis=1)]]
+    else:
+        selected = numpy.ones(len(atoms), dtype=bool)
+
+    #Molecules without heavy atoms are aligned on all of them
+    if not selected.any():
+        selected[:] = True
+    idx = numpy.nonzero(selected)[0]
+
+    if settings.RMSDMassWeight:
+        w = numpy.array([AtomMass(atoms[a]) for a in idx], dtype=numpy.float64)
+    else:
+        w = numpy.ones(len(idx), dtype=numpy.float64)
+
+    return idx, w
+
+
+#Mass of an atom from its symbol, 1 for symbols missing from the table
+def AtomMass(symbol):
+
+    AtomNum = GetAtomNum(symbol)
+    if AtomNum < 1 or AtomNum > 56:
+        return 1.0
+
+    return float(GetAtomWeight(AtomNum))
+
+
+#Centered coordinates of the aligned atoms of all conformers, and their
+#weights, as selected by AlignedAtoms
+def PruneCoords(conformers, atoms, settings):
+
+    coords = GetCoordArray(conformers)
+    idx, w = AlignedAtoms(atoms, coords, settings)
+    if len(idx) < len(atoms):
+        print("Aligning conformers on " + str(len(idx)) + " of " +
+              str(len(atoms)) + " atoms")
+
+    return CenterCoords(coords[:, idx], w), w
+
+
+#Translates all conformers so that their weighted centroids are at the origin
+def CenterCoords(coords, w):
+
+    centroids = numpy.einsum('cak,a->ck', coords, w)/w.sum()
+
+    return coords - centroids[:, None, :]
+
+
+#Distance of every atom from the centroid, for centered coordinates
+def CentroidDistances(coords):
+
+    return numpy.sqrt(numpy.einsum('cak,cak->ca', coords, coords))
+
+
+"""
+Rotation invariant lower bounds of the RMSDs between two stacks of
+conformers, from their centroid distance profiles PX and PY. With both
+centroids at the origin, no rotation can bring atom a of one conformer
+closer to atom a of the other than the difference of their distances
+from the origin, so the weighted RMS of these differences is never above
+the RMSD. It is also never below the difference of the radii of gyration.
+Returns the (len(PX), len(PY)) array of bounds.
+"""
+def LowerBounds(PX, PY, w):
+
+    PX2 = numpy.dot(PX**2, w)
+    PY2 = numpy.dot(PY**2, w)
+    msd = (PX2[:, None] + PY2[None, :] - 2.0*numpy.dot(PX*w, PY.T))/w.sum()
+
+    return numpy.sqrt(numpy.maximum(msd, 0.0))
+
+
+"""
+Condensed storage of the upper triangle of an RMSD matrix. The RMSD of
+conformers c1 < c2 is at CondensedIndex(c1, l) + c2 - c1 - 1, so every row
+of the triangle is a contiguous stretch, and only l*(l-1)/2 values are kept.
+
+The values are stored as float64, float32 or uint16 fixed point with a
+FixedPointStep resolution. The store lives in memory unless it is bigger
+than MemoryLimit megabytes or a file is given, in which case it is a
+disk-backed memory map, temporary if no file was given.
+"""
+class RMSDStore:
+
+    def __init__(self, l, encoding='float64', MemoryLimit=2000,
+                 filename='', data=None):
+        self.l = l
+        if data is not None:
+            self.data = data
+            self.filename = filename
+            self.temporary = False
+            return
+
+        npairs = l*(l-1)//2
+        dtype = numpy.dtype(encoding)
+        self.temporary = False
+        if filename == '' and npairs*dtype.itemsize > MemoryLimit*1024*1024:
+            fd, filename = tempfile.mkstemp(prefix='ConfPrune', suffix='.npy')
+            os.close(fd)
+            self.temporary = True
+            print("RMSD matrix exceeds " + str(MemoryLimit) +
+                  " MB, storing it on disk in " + filename)
+        self.filename = filename
+        if filename == '':
+            self.data = numpy.empty(npairs, dtype=dtype)
+        else:
+            self.data = numpy.lib.format.open_memmap(filename, mode='w+',
+                                                     dtype=dtype,
+                                                     shape=(npairs,))
+
+    def __len__(self):
+        return self.l
+
+    def __del__(self):
+        self.Close()
+
+    def Close(self):
+        if self.temporary and os.path.exists(self.filename):
+            self.data = None
+            os.remove(self.filename)
+
+    def Encode(self, values):
+        if self.data.dtype == numpy.uint16:
+            return numpy.minimum(numpy.rint(values/FixedPointStep), 65535)
+        else:
+            return values
+
+    def Decode(self, values):
+        if self.data.dtype == numpy.uint16:
+            return values*FixedPointStep
+        else:
+            return numpy.asarray(values, dtype=numpy.float64)
+
+    #RMSDs of conformer c1 to all the later conformers
+    def Row(self, long int c1):
+        start = CondensedIndex(c1, self.l)
+        return self.Decode(self.data[start:start + self.l - c1 - 1])
+
+    def SetRows(self, long int c1, long int c2, values):
+        self.data[CondensedIndex(c1, self.l):CondensedIndex(c2, self.l)] = \
+            self.Encode(values)
+
+    #Condensed indices and values of the RMSDs in [low, high)
+    def Pairs(self, low, high):
+        cdef long int c1
+        found = [numpy.zeros(0, dtype=int)]
+        for c1 in range(0, self.l-1):
+            row = self.Row(c1)
+            found.append(CondensedIndex(c1, self.l) +
+                         numpy.nonzero((row >= low) & (row < high))[0])
+        pairs = numpy.concatenate(found)
+        return pairs, self.Decode(self.data[pairs])
+
+    #Sorted distinct RMSDs in [low, high)
+    def Between(self, low, high):
+        cdef long int c1
+        found = [numpy.zeros(0)]
+        for c1 in range(0, self.l-1):
+            row = self.Row(c1)
+            found.append(numpy.unique(row[(row >= low) & (row < high)]))
+        return numpy.unique(numpy.concatenate(found))
+
+
+#Calculates the optimal superposition RMSDs of all conformer pairs of the
+#ensemble, using the number of processes and storage set in settings.
+#If cutoff is given, pairs whose lower bound is not below it are not
+#aligned and hold their bound, and such a matrix is never cached
+def RMSDMatrix(conformers, atoms, cachefile='', settings=None, cutoff=None):
+
+    cdef long int l = len(conformers)
+
+    if settings is None:
+        settings = PruneDefaults()
+
+    if cachefile != '' and os.path.exists(cachefile):
+        data = numpy.load(cachefile, mmap_mode='r')
+        if data.shape == (l*(l-1)//2,):
+            print("RMSD matrix read from " + cachefile)
+            return RMSDStore(l, filename=cachefile, data=data)
+
+    if l < 2:
+        return RMSDStore(l, settings.RMSDEncoding)
+
+    if cutoff is not None:
+        cachefile = ''
+
+    if cachefile != '':
+        #Written under a temporary name first, so that an interrupted
+        #run never leaves a truncated cache behind
+        RMSDs = RMSDStore(l, settings.RMSDEncoding, filename=cachefile + '.tmp')
+    else:
+        RMSDs = RMSDStore(l, settings.RMSDEncoding, settings.RMSDMemoryLimit)
+
+    coords, w = PruneCoords(conformers, atoms, settings)
+    nskipped = CondensedRMSDs(coords, w, RMSDs, settings.PruneProc, cutoff)
+    if cutoff is not None:
+        print(str(nskipped) + " of " + str(l*(l-1)//2) +
+              " alignments skipped by the lower bound prefilter")
+
+    if cachefile != '':
+        RMSDs.data.flush()
+        os.rename(cachefile + '.tmp', cachefile)
+        RMSDs.filename = cachefile
+
+    return RMSDs
+
+
+"""
+Computes the upper triangle of the RMSD matrix into an RMSDStore.
+
+The triangle is split into bands of consecutive rows of about PairBlockSize
+pairs each, which are contiguous in the condensed store. With nproc > 1
+the bands are handed to a pool of worker processes, which read the
+centered coordinates from a memory-mapped file and write their band
+straight into a shared memory-mapped store.
+
+If cutoff is given, only the pairs with a lower bound below it are aligned.
+Returns the number of alignments skipped this way.
+"""
+def CondensedRMSDs(coords, w, RMSDs, long int nproc=1, cutoff=None):
+
+    cdef long int l = coords.shape[0]
+    G = numpy.einsum('cak,a->c', coords**2, w)
+    Bands = RowBands(l)
+    if cutoff is not None:
+        P = CentroidDistances(coords)
+    else:
+        P = None
+
+    if nproc < 2 or len(Bands) < 2:
+        return sum([BandRMSDs(coords, w, G, Band, RMSDs, P, cutoff)
+                    for Band in Bands])
+
+    import shutil
+    import multiprocessing
+
+    tempdir = tempfile.mkdtemp(prefix='ConfPrune')
+    try:
+        coordsfile = os.path.join(tempdir, 'coords.npy')
+        numpy.save(coordsfile, coords)
+
+        #Workers need a file to share, in-memory stores are copied back
+        if RMSDs.filename == '':
+            Shared = RMSDStore(l, RMSDs.data.dtype,
+                               filename=os.path.join(tempdir, 'rmsd.npy'))
+        else:
+            Shared = RMSDs
+        Shared.data.flush()
+
+        pool = multiprocessing.Pool(nproc, InitBandWorker,
+                                    (coordsfile, Shared.filename, w, G, P,
+                                     cutoff))
+        try:
+            nskipped = sum(pool.map(BandWorker, Bands, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+
+        if Shared is not RMSDs:
+            RMSDs.data[:] = numpy.load(Shared.filename, mmap_mode='r')
+            Shared.data = None
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    return nskipped
+
+
+#Offset of the first pair of row c1 in the condensed upper triangle
+def CondensedIndex(long int c1, long int l):
+    return c1*(2*l - c1 - 1)//2
+
+
+#Splits the rows of the upper triangle into bands of about PairBlockSize pairs
+def RowBands(long int l):
+
+    cdef long int c1 = 0, start = 0, npairs = 0
+    Bands = []
+
+    for c1 in range(0, l-1):
+        npairs += l - c1 - 1
+        if npairs >= PairBlockSize or c1 == l-2:
+            Bands.append((start, c1+1))
+            start = c1+1
+            npairs = 0
+
+    return Bands
+
+
+#Aligns the rows [Band[0], Band[1]) with all later conformers and writes the
+#results into their contiguous stretch of the condensed store. With the
+#centroid distance profiles P and a cutoff, only the pairs with a lower
+#bound below the cutoff are aligned, the others keep their bound. Returns
+#the number of skipped alignments
+def BandRMSDs(coords, w, G, Band, RMSDs, P=None, cutoff=None):
+
+    cdef long int i0 = Band[0], i1 = Band[1]
+    cdef long int k, start
+    cdef long int nskipped = 0
+
+    if P is None:
+        R = BlockRMSD(coords[i0:i1], coords[i0+1:], w, G[i0:i1], G[i0+1:])
+    else:
+        R = LowerBounds(P[i0:i1], P[i0+1:], w)
+        #Row k of the block holds the pairs of conformer i0+k from column k
+        upper = numpy.arange(R.shape[1])[None, :] >= \
+            numpy.arange(R.shape[0])[:, None]
+        ii, jj = numpy.nonzero((R < cutoff + BoundSlack) & upper)
+        nskipped = upper.sum() - len(ii)
+        #Gathering the pairs costs about twice as much per pair as the
+        #block product, so it only pays off if most of them are skipped
+        if 3*len(ii) > upper.sum():
+            ii = jj = ii[:0]
+            nskipped = 0
+            R = BlockRMSD(coords[i0:i1], coords[i0+1:], w, G[i0:i1], G[i0+1:])
+        for start in range(0, len(ii), PairChunkSize):
+            a = i0 + ii[start:start + PairChunkSize]
+            b = i0 + 1 + jj[start:start + PairChunkSize]
+            R[a - i0, b - i0 - 1] = PairRMSD(coords[a], coords[b], w,
+                                             G[a], G[b])
+
+    RMSDs.SetRows(i0, i1, numpy.concatenate([R[k, k:] for k in range(i1-i0)]))
+
+    return nskipped
+
+
+#State of the pool worker processes, set up once per worker
+BandWorkerData = {}
+
+def InitBandWorker(coordsfile, storefile, w, G, P, cutoff):
+    BandWorkerData['coords'] = numpy.load(coordsfile, mmap_mode='r')
+    data = numpy.load(storefile, mmap_mode='r+')
+    BandWorkerData['store'] = RMSDStore(len(BandWorkerData['coords']),
+                                        filename=storefile, data=data)
+    BandWorkerData['w'] = w
+    BandWorkerData['G'] = G
+    BandWorkerData['P'] = P
+    BandWorkerData['cutoff'] = cutoff
+
+
+def BandWorker(Band):
+    nskipped = BandRMSDs(BandWorkerData['coords'], BandWorkerData['w'],
+                         BandWorkerData['G'], Band, BandWorkerData['store'],
+                         BandWorkerData['P'], BandWorkerData['cutoff'])
+    BandWorkerData['store'].data.flush()
+    return nskipped
+
+
+"""
+Vectorized quaternion superposition. X and Y are stacks of centered
+molecules, w the atom weights and GX, GY the weighted inner products
+of every molecule with itself. Returns the (len(X), len(Y)) array of
+minimal RMSDs.
+
+For every pair the weighted correlation matrix S = X^T W Y is folded into
+the 4x4 quadratic form of Horn, whose largest eigenvalue gives the
+minimal residual (GX + GY - 2*lambda)/sum(w).
+"""
+def BlockRMSD(X, Y, w, GX, GY):
+
+    bi, na = X.shape[0], X.shape[1]
+    bj = Y.shape[0]
+
+    #All the correlation matrices for the block in a single matrix product
+    Xw = (X * w[None, :, None]).transpose(0, 2, 1).reshape(bi*3, na)
+    Yt = Y.transpose(1, 0, 2).reshape(na, bj*3)
+    S = numpy.dot(Xw, Yt).reshape(bi, 3, bj, 3).transpose(0, 2, 1, 3)
+
+    return CorrelationRMSD(S, GX[:, None], GY[None, :], w.sum())
+
+
+#Same as BlockRMSD for the pairs X[i], Y[i] only, returns len(X) RMSDs
+def PairRMSD(X, Y, w, GX, GY):
+
+    S = numpy.matmul((X * w[None, :, None]).transpose(0, 2, 1), Y)
+
+    return CorrelationRMSD(S, GX, GY, w.sum())
+
+
+"""
+Minimal RMSDs from a stack of correlation matrices S[..., 3, 3], the
+matching self inner products GX, GY and the total weight W.
+
+The largest eigenvalue of the quaternion matrix is found without building
+or diagonalising it, as the largest root of its characteristic polynomial
+x^4 + C2 x^2 + C1 x + C0 (the QCP method of Theobald, Acta Cryst. A61,
+478, 2005). The coefficients are written out in terms of S, and Newton
+steps from the upper bound (GX + GY)/2 converge monotonically onto the
+root, for all pairs of the stack at once.
+"""
+def CorrelationRMSD(S, GX, GY, W):
+
+    Sxx, Sxy, Sxz = S[..., 0, 0], S[..., 0, 1], S[..., 0, 2]
+    Syx, Syy, Syz = S[..., 1, 0], S[..., 1, 1], S[..., 1, 2]
+    Szx, Szy, Szz = S[..., 2, 0], S[..., 2, 1], S[..., 2, 2]
+
+    Sxx2, Syy2, Szz2 = Sxx*Sxx, Syy*Syy, Szz*Szz
+    Sxy2, Syz2, Sxz2 = Sxy*Sxy, Syz*Syz, Sxz*Sxz
+    Syx2, Szy2, Szx2 = Syx*Syx, Szy*Szy, Szx*Szx
+
+    SyzSzymSyySzz2 = 2.0*(Syz*Szy - Syy*Szz)
+    Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2
+    Sxy2Sxz2Syx2Szx2 = Sxy2 + Sxz2 - Syx2 - Szx2
+
+    SxzpSzx, SyzpSzy, SxypSyx = Sxz + Szx, Syz + Szy, Sxy + Syx
+    SyzmSzy, SxzmSzx, SxymSyx = Syz - Szy, Sxz - Szx, Sxy - Syx
+    SxxpSyy, SxxmSyy = Sxx + Syy, Sxx - Syy
+
+    C2 = -2.0*(Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2)
+    C1 = 8.0*(Sxx*Syz*Szy + Syy*Szx*Sxz + Szz*Sxy*Syx -
+              Sxx*Syy*Szz - Syz*Szx*Sxy - Szy*Syx*Sxz)
+    C0 = Sxy2Sxz2Syx2Szx2*Sxy2Sxz2Syx2Szx2 + \
+        (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * \
+        (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2) + \
+        (-SxzpSzx*SyzmSzy + SxymSyx*(SxxmSyy - Szz)) * \
+        (-SxzmSzx*SyzpSzy + SxymSyx*(SxxmSyy + Szz)) + \
+        (-SxzpSzx*SyzpSzy - SxypSyx*(SxxpSyy - Szz)) * \
+        (-SxzmSzx*SyzmSzy - SxypSyx*(SxxpSyy + Szz)) + \
+        (SxypSyx*SyzpSzy + SxzpSzx*(SxxmSyy + Szz)) * \
+        (-SxymSyx*SyzmSzy + SxzpSzx*(SxxpSyy + Szz)) + \
+        (SxypSyx*SyzmSzy + SxzmSzx*(SxxmSyy - Szz)) * \
+        (-SxymSyx*SyzpSzy + SxzmSzx*(SxxpSyy - Szz))
+
+    cdef int i
+    E0 = 0.5*(GX + GY)
+    lmax = E0 + numpy.zeros_like(C0)
+    for i in range(QCPMaxIter):
+        x2 = lmax*lmax
+        b = (x2 + C2)*lmax
+        a = b + C1
+        delta = (a*lmax + C0)/(2.0*x2*lmax + b + a)
+        lmax -= delta
+        if not (numpy.abs(delta) > QCPPrecision*numpy.abs(lmax)).any():
+            break
+
+    msd = (2.0*E0 - 2.0*lmax)/W
+
+    return numpy.sqrt(numpy.maximum(msd, 0.0))
+
+
+#Quaternion matrix of Horn for the correlation matrices S[..., 3, 3], its
+#largest eigenvalue and eigenvector give the optimal rotation
+def QuaternionMatrix(S):
+
+    Sxx, Sxy, Sxz = S[..., 0, 0], S[..., 0, 1], S[..., 0, 2]
+    Syx, Syy, Syz = S[..., 1, 0], S[..., 1, 1], S[..., 1, 2]
+    Szx, Szy, Szz = S[..., 2, 0], S[..., 2, 1], S[..., 2, 2]
+
+    K = numpy.empty(S.shape[:-2] + (4, 4), dtype=numpy.float64)
+    K[..., 0, 0] = Sxx + Syy + Szz
+    K[..., 1, 1] = Sxx - Syy - Szz
+    K[..., 2, 2] = -Sxx + Syy - Szz
+    K[..., 3, 3] = -Sxx - Syy + Szz
+    K[..., 0, 1] = K[..., 1, 0] = Syz - Szy
+    K[..., 0, 2] = K[..., 2, 0] = Szx - Sxz
+    K[..., 0, 3] = K[..., 3, 0] = Sxy - Syx
+    K[..., 1, 2] = K[..., 2, 1] = Sxy + Syx
+    K[..., 1, 3] = K[..., 3, 1] = Szx + Sxz
+    K[..., 2, 3] = K[..., 3, 2] = Syz + Szy
+
+    return K
 
 
 def AlignMolecules(mol1, mol2, atoms):
@@ -299,164 +1099,33 @@ def GetAtomWeight(AtomNum):
  *   z      - eigenvalue
  *   q      - the best-fit quaternion
  *   u      - the best-fit left rotation matrix
- *   nr     - number of jacobi sweeps required
  
  KE:
  structure of molecule data:
  a[atomnr][coordinate]
+
+ The quadratic form is diagonalised with numpy.linalg.eigh, which replaces
+ the Jacobi routine of the original and keeps no module level state.
  """
-cdef double v[4][4]
-cdef double d[4]
-    
 def qtrfit(mol, refmol, w):
-    
-    cdef int n = len(mol)
-    cdef double xxyx = 0.0, xxyy = 0.0, xxyz = 0.0, xyyx = 0.0, xyyy = 0.0
-    cdef double xyyz = 0.0, xzyx = 0.0, xzyy = 0.0, xzyz = 0.0
-    cdef double c[4][4]
-    cdef double q[4]
-    cdef int i, j
-    #generate the upper triangle of the quadratic form matrix:
-    for i in range(0,n):
-        xxyx += mol[i][0] * refmol[i][0] * w[i]
-        xxyy += mol[i][0] * refmol[i][1] * w[i]
-        xxyz += mol[i][0] * refmol[i][2] * w[i]
-        xyyx += mol[i][1] * refmol[i][0] * w[i]
-        xyyy += mol[i][1] * refmol[i][1] * w[i]
-        xyyz += mol[i][1] * refmol[i][2] * w[i]
-        xzyx += mol[i][2] * refmol[i][0] * w[i]
-        xzyy += mol[i][2] * refmol[i][1] * w[i]
-        xzyz += mol[i][2] * refmol[i][2] * w[i]
-    
-    c[0][0] = xxyx + xyyy + xzyz
-    c[0][1] = xzyy - xyyz
-    c[1][1] = xxyx - xyyy - xzyz
-    c[0][2] = xxyz - xzyx
-    c[1][2] = xxyy + xyyx
-    c[2][2] = xyyy - xzyz - xxyx
-    c[0][3] = xyyx - xxyy
-    c[1][3] = xzyx + xxyz
-    c[2][3] = xyyz + xzyy
-    c[3][3] = xzyz - xxyx - xyyy
-    
-    #Diagonalize c
-    cdef double **ret
-    ret = qtrjac(c, 4, 4)
-        
-    #extract the desired quaternion
-    cdef double z = d[3]
-    q[0] = v[0][3]
-    q[1] = v[1][3]
-    q[2] = v[2][3]
-    q[3] = v[3][3]
-    
+
+    #Correlation of the reference with the molecule, in this order the
+    #quaternion matrix is the quadratic form above
+    S = numpy.einsum('ak,a,al->kl', numpy.asarray(refmol, dtype=numpy.float64),
+                     numpy.asarray(w, dtype=numpy.float64),
+                     numpy.asarray(mol, dtype=numpy.float64))
+
+    #The eigenvalues come in ascending order, the last vector is the
+    #desired quaternion
+    z, v = numpy.linalg.eigh(QuaternionMatrix(S))
+    q = v[:, 3]
+
     #generate the rotation matrix
     u = q2mat(q)
-    
-    return u
 
-cdef double** qtrjac(double a[4][4], int n, int np):
-    
-    """v = [[0.0, 0.0, 0.0, 0.0],[0.0, 0.0, 0.0, 0.0],\
-        [0.0, 0.0, 0.0, 0.0],[0.0, 0.0, 0.0, 0.0]]
-    d = [0.0, 0.0, 0.0, 0.0]
-    onorm = 0.0
-    dnorm = 0.0
-    b = 0.0
-    dma = 0.0
-    q = 0.0
-    t= 0.0
-    c = 0.0
-    s = 0.0
-    atemp = 0.0
-    vtemp = 0.0
-    dtemp = 0.0
-    nrot = 128"""
-    cdef double onorm, dnorm, b, dma, q, t, c, s, atemp, vtemp, dtemp
-    cdef int nrot = 128
-    cdef int j, i, l, k
-    for j in range(0,n):
-        for i in range(0,n):
-            v[i][j]=0.0
-        v[j][j] = 1.0
-        d[j] = a[j][j]
-
-    for l in range(0, nrot):
-        dnorm = 0.0
-        onorm = 0.0
-        for j in range(0, n):
-            dnorm += abs(d[j])
-            for i in range(j-1):
-                onorm += abs(a[i][j])
-        if (onorm + dnorm) <= dnorm:
-            break
-        
-        for j in range(1, n):
-            
-            for i in range(0,j-1):
-                
-                b = a[i][j]
-                if (abs(b)>0.0):
-                    dma = d[j] - d[i]
-                    if (abs(dma)+abs(b) < abs(dma)):
-                        t = b/dma
-                    else:
-                        q = 0.5 * dma / b
-                        t = fsign(1.0 / (abs(q) + sqrt(1.0 + q*q)), q)
-                    
-                    c = 1.0 / sqrt(t*t + 1.0)
-                    s = t * c
-                    a[i][j] = 0.0
-                    
-                    for k in range(0, i-1):
-                        atemp = c * a[k][i] - s * a[k][j]
-                        a[k][j] = s * a[k][i] + c * a[k][j]
-                        a[k][i] = atemp
-                        
-                    for k in range(i+1, j):
-                        atemp = c * a[i][k] - s * a[k][j]
-                        a[k][j] = s * a[i][k] + c * a[k][j]
-                        a[i][k] = atemp
-                        
-                    for k in range(j, n):
-                        atemp = c * a[i][k] - s * a[j][k]
-                        a[j][k] = s * a[i][k] + c * a[j][k]
-                        a[i][k] = atemp
-                    
-                    for k in range(0, n):
-                        vtemp = c * v[k][i] - s * v[k][j]
-                        v[k][j] = s * v[k][i] + c * v[k][j]
-                        v[k][i] = vtemp
-                    
-                    dtemp = c * c * d[i] + s * s * d[j] - 2.0 + c * s * b
-                    d[j] = s * s * d[i] + c * c * d[j] + 2.0 * c * s * b
-                    d[i] = dtemp
-    nrot = l
-    
-    for j in range(0, n-1):
-        k = j
-        dtemp = d[k]
-        for i in range(j, n):
-            if d[i]<dtemp:
-                k = i
-                dtemp = d[k]
-        if k>j:
-            d[k] = d[j]
-            d[j] = dtemp
-            for i in range(0, n):
-                dtemp = v[i][k]
-                v[i][k] = v[i][j]
-                v[i][j] = dtemp
-    
-    cdef double ret[5][4]
-    for i in range(0,4):
-        for j in range(0,4):
-            ret[i][j]=v[i][j]
-    for i in range(0,4):
-        ret[4][i] = d[i]
-    
+    return u
 
-cdef q2mat(double q[4]):
+def q2mat(q):
     
     u = [[0.0, 0.0, 0.0],[0.0, 0.0, 0.0],[0.0, 0.0, 0.0]]
     u[0][0] = q[0]*q[0] + q[1]*q[1] - q[2]*q[2] - q[3]*q[3]
@@ -470,9 +1139,3 @@ cdef q2mat(double q[4]):
     u[2][2] = q[0]*q[0] - q[1]*q[1] - q[2]*q[2] + q[3]*q[3]
     
     return u
-
-def fsign(a, b):
-    if (b>=0):
-        return a
-    else:
-        return -a
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:40 2026
+
+@author: ke291
+
+Compact representation of a conformer ensemble. Produced by the MM output
+readers in MacroModel.py and Tinker.py and consumed by ConfPrune.pyx and
+the DFT input writers, which read the ensembles through ReadConformers and
+its on-disk cache of parsed conformers.
+"""
+
+import hashlib
+import os
+
+import numpy
+
+gasConstant = 8.3145
+temperature = 298.15
+
+#Contents hashes of the files by path, with the size and modification time
+#they were computed for
+FileHashes = {}
+
+
+class Ensemble:
+    """
+    Holds the coordinates of all conformers as one contiguous
+    (nconf, natoms, 3) float array, together with the atom symbols,
+    conformer energies in kJ/mol and the molecular charge.
+
+    Indexing an ensemble returns a conformer in the text form used by the
+    input file writers, [[atomnum, x, y, z], ...], so an Ensemble can be
+    used anywhere the old lists of conformers were used.
+    """
+
+    def __init__(self, atoms, coords, charge=0, energies=None,
+                 dtype=numpy.float64):
+        self.atoms = numpy.array(atoms)
+        self.coords = numpy.ascontiguousarray(coords, dtype=dtype)
+        if self.coords.ndim != 3:
+            self.coords = self.coords.reshape(-1, len(self.atoms), 3)
+        self.charge = charge
+        if energies is None:
+            self.energies = numpy.zeros(len(self.coords))
+        else:
+            self.energies = numpy.array(energies, dtype=numpy.float64)
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def __getitem__(self, i):
+        return [[str(a+1)] + [format(x, '.6f') for x in xyz]
+                for a, xyz in enumerate(self.coords[i])]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def Subset(self, indices):
+        return Ensemble(self.atoms, self.coords[indices], self.charge,
+                        self.energies[indices], self.coords.dtype)
+
+
+class LazyEnsemble(Ensemble):
+    """
+    Ensemble whose coordinates are read from the MM output only when they
+    are needed. loader(indices) returns the (len(indices), natoms, 3)
+    coordinates of the given conformers of the source. Conformers that are
+    indexed one at a time are read on their own, the coords array of the
+    whole ensemble is read in one go the first time it is used.
+    """
+
+    def __init__(self, atoms, loader, indices, charge=0, energies=None,
+                 dtype=numpy.float64):
+        self.atoms = numpy.array(atoms)
+        self.loader = loader
+        self.indices = numpy.asarray(indices, dtype=numpy.intp)
+        self.charge = charge
+        self.dtype = dtype
+        if energies is None:
+            self.energies = numpy.zeros(len(self.indices))
+        else:
+            self.energies = numpy.array(energies, dtype=numpy.float64)
+
+    def __getattr__(self, name):
+        if name != 'coords':
+            raise AttributeError(name)
+        self.coords = numpy.ascontiguousarray(self.loader(self.indices),
+                                              dtype=self.dtype)
+        return self.coords
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if 'coords' in self.__dict__:
+            return Ensemble.__getitem__(self, i)
+        xyzs = self.loader(self.indices[[i]])[0]
+        return [[str(a+1)] + [format(x, '.6f') for x in xyz]
+                for a, xyz in enumerate(xyzs)]
+
+    def Subset(self, indices):
+        if 'coords' in self.__dict__:
+            return Ensemble.Subset(self, indices)
+        return LazyEnsemble(self.atoms, self.loader, self.indices[indices],
+                            self.charge, self.energies[indices], self.dtype)
+
+
+def CoordType(settings):
+    if settings.SinglePrecisionCoords:
+        return numpy.float32
+    else:
+        return numpy.float64
+
+
+#Names of the MM output files an ensemble is read from
+def MMOutputFiles(MMoutp, settings):
+    if settings.MMTinker:
+        ext = '.tout'
+    else:
+        ext = '-out.mae'
+
+    files = [MMoutp + ext]
+    if settings.Rot5Cycle is True:
+        files.append(MMoutp + 'rot' + ext)
+
+    return files
+
+
+#Hash of the MM output contents and of the settings that decide which
+#conformers are read, used to name files derived from the ensemble
+def CacheKey(MMoutp, settings, *extra):
+
+    md5 = hashlib.md5()
+    for f in MMOutputFiles(MMoutp, settings):
+        md5.update(FileHash(f))
+    md5.update(repr((settings.MaxCutoffEnergy,) + extra))
+
+    return md5.hexdigest()[:16]
+
+
+#Hash of the contents of a file. A file is only read again when its size or
+#modification time has changed since the last call of the run
+def FileHash(f):
+
+    path = os.path.abspath(f)
+    st = os.stat(path)
+    Stats = (st.st_size, st.st_mtime)
+    if path not in FileHashes or FileHashes[path][0] != Stats:
+        md5 = hashlib.md5()
+        infile = open(path, 'rb')
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            md5.update(chunk)
+        infile.close()
+        FileHashes[path] = (Stats, md5.hexdigest())
+
+    return FileHashes[path][1]
+
+
+#On-disk RMSD matrix of the ensemble, stored next to the MM output
+def RMSDCacheFile(MMoutp, settings):
+    return MMoutp + '-rmsd-' + CacheKey(MMoutp, settings,
+                                        settings.RMSDEncoding,
+                                        settings.RMSDAtoms,
+                                        settings.RMSDMassWeight,
+                                        settings.PopulationTarget,
+                                        settings.PopulationConfLimit) + '.npy'
+
+
+"""
+Reads the conformers of an MM output with the MacroModel or Tinker reader
+and returns what the reader returns, with the ensemble reduced by the
+Boltzmann population screen if one is set (not used with Cluster).
+"""
+def ReadConformers(MMoutp, settings):
+
+    res = ReadMMConformers(MMoutp, settings)
+
+    if settings.Cluster == False and (settings.PopulationTarget < 1.0 or
+                                      settings.PopulationConfLimit > 0):
+        res = (res[0], BoltzmannScreen(res[1], MMoutp, settings)) + \
+            tuple(res[2:])
+
+    return res
+
+
+"""
+Reads the conformers of an MM output with the MacroModel or Tinker reader.
+The parsed ensemble is kept in an npz file next to the MM output and reused
+by later calls, also in later runs.
+
+The cache is used if it was written with the same energy window, Rot5Cycle,
+Cluster and charge settings and the MM output files still have the recorded
+sizes and modification times. If only the times differ, the cache is still
+used when the contents hash is unchanged.
+"""
+def ReadMMConformers(MMoutp, settings):
+
+    cachefile = ConformerCacheFile(MMoutp, settings)
+    Options = ConformerCacheOptions(settings)
+    Stats = MMOutputStats(MMoutp, settings)
+
+    if os.path.exists(cachefile):
+        data = numpy.load(cachefile)
+        if str(data['options']) == Options:
+            valid = numpy.array_equal(data['stats'], Stats)
+            if not valid and data['stats'].shape == Stats.shape and \
+                    numpy.array_equal(data['stats'][:, 0], Stats[:, 0]):
+                valid = str(data['key']) == CacheKey(MMoutp, settings)
+            if valid:
+                print "Conformers read from " + cachefile
+                atoms = [str(a) for a in data['atoms']]
+                charge = int(data['charge'])
+                ensemble = Ensemble(atoms, data['coords'], charge,
+                                    data['energies'], CoordType(settings))
+                if settings.Cluster == True and not settings.MMTinker:
+                    return atoms, ensemble, charge, list(data['AbsEs'])
+                return atoms, ensemble, charge
+
+    if settings.MMTinker:
+        import Tinker
+        res = Tinker.ReadTinker(MMoutp, settings)
+    else:
+        import MacroModel
+        res = MacroModel.ReadMacromodel(MMoutp, settings)
+
+    atoms, ensemble, charge = res[:3]
+    if len(res) > 3:
+        AbsEs = res[3]
+    else:
+        AbsEs = []
+
+    #Written under a temporary name first, so that an interrupted run never
+    #leaves a truncated cache behind
+    outfile = open(cachefile + '.tmp', 'wb')
+    numpy.savez(outfile, atoms=numpy.array(atoms), coords=ensemble.coords,
+                energies=ensemble.energies, charge=charge,
+                AbsEs=numpy.array(AbsEs, dtype=numpy.float64),
+                options=Options, stats=Stats,
+                key=CacheKey(MMoutp, settings))
+    outfile.close()
+    if os.path.exists(cachefile):
+        os.remove(cachefile)
+    os.rename(cachefile + '.tmp', cachefile)
+
+    return res
+
+
+#Parsed conformer cache, stored next to the MM output
+def ConformerCacheFile(MMoutp, settings):
+    if settings.MMTinker:
+        return MMoutp + '-tinker-confs.npz'
+    else:
+        return MMoutp + '-confs.npz'
+
+
+#Settings that decide which conformers are read and what is returned
+def ConformerCacheOptions(settings):
+    return repr((settings.MaxCutoffEnergy, settings.Rot5Cycle,
+                 settings.Cluster, settings.charge))
+
+
+#Size and modification time of every MM output file
+def MMOutputStats(MMoutp, settings):
+
+    Stats = []
+    for f in MMOutputFiles(MMoutp, settings):
+        st = os.stat(f)
+        Stats.append([st.st_size, st.st_mtime])
+
+    return numpy.array(Stats, dtype=numpy.float64)
+
+
+"""
+Boltzmann population screen on the MM energies. Keeps the lowest energy
+conformers until their summed population reaches settings.PopulationTarget,
+and at most settings.PopulationConfLimit of them if that is above 0. The
+screen is written to MMoutp-boltzmann.txt with the population of every
+conformer and the population mass that was discarded. Returns the kept
+conformers in their original order.
+"""
+def BoltzmannScreen(ensemble, MMoutp, settings):
+
+    RelEs = ensemble.energies - ensemble.energies.min()
+    populations = numpy.exp(-RelEs*1000/(gasConstant*temperature))
+    populations /= populations.sum()
+
+    order = numpy.argsort(RelEs, kind='mergesort')
+    nkept = len(order)
+    if settings.PopulationTarget < 1.0:
+        CumPops = numpy.cumsum(populations[order])
+        nkept = min(nkept, numpy.searchsorted(CumPops,
+                                              settings.PopulationTarget) + 1)
+    if settings.PopulationConfLimit > 0:
+        nkept = min(nkept, settings.PopulationConfLimit)
+
+    Kept = numpy.sort(order[:nkept])
+    KeptPop = populations[Kept].sum()
+
+    print str(nkept) + " of " + str(len(ensemble)) + " conformers kept by " +\
+        "the MM Boltzmann screen, discarded population " +\
+        format(100*(1 - KeptPop), ".2f") + "%"
+
+    report = open(MMoutp + '-boltzmann.txt', 'w')
+    report.write("MM Boltzmann screen at " + format(temperature, ".2f") +
+                 " K\n")
+    report.write("Population target: " +
+                 format(100*settings.PopulationTarget, ".2f") + "%\n")
+    report.write("Conformer limit: " + str(settings.PopulationConfLimit) +
+                 "\n")
+    report.write("Conformers kept: " + str(nkept) + " of " +
+                 str(len(ensemble)) + "\n")
+    report.write("Kept population: " + format(100*KeptPop, ".4f") + "%\n")
+    report.write("Discarded population: " + format(100*(1 - KeptPop), ".4f") +
+                 "%\n\n")
+    report.write("Conf  RelE(kJ/mol)  Population(%)  Kept\n")
+    kept = numpy.zeros(len(ensemble), dtype=bool)
+    kept[Kept] = True
+    for c in order:
+        report.write(str(c+1).rjust(4) + format(RelEs[c], "14.3f") +
+                     format(100*populations[c], "15.4f") +
+                     ("yes" if kept[c] else "no").rjust(6) + "\n")
+    report.close()
+
+    return ensemble.Subset(Kept)
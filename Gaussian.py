@@ -10,12 +10,13 @@ Contains all of the Gaussian specific code for input generation and calculation
 execution. Called by PyDP4.py.
 """
 
-import Tinker
-import MacroModel
+import Conformers
+import ConfCluster
+import JobScheduler
+import Transport
 import nmrPredictGaus
 
 import subprocess
-import socket
 import os
 import time
 import sys
@@ -35,32 +36,59 @@ else:
 
 from openbabel import *
 
-def SetupGaussian(MMoutp, Gausinp, numDigits, settings, adjRMSDcutoff):
-
-    if settings.MMTinker:
-        #Reads conformer geometry, energies and atom labels from Tinker output
-        (atoms, conformers, charge) = Tinker.ReadTinker(MMoutp, settings)
-    else:
-        (atoms, conformers, charge) = MacroModel.ReadMacromodel(MMoutp,
-                                                                settings)
-    if settings.charge is not None:
-        charge = settings.charge
-
-    #Prune similar conformations, if the number exceeds the limit
-    if len(conformers) > settings.PerStructConfLimit and settings.ConfPrune:
-        pruned = ConfPrune.RMSDPrune(conformers, atoms, adjRMSDcutoff)
-        actualRMSDcutoff = adjRMSDcutoff
+def SetupGaussian(MMoutp, Gausinp, numDigits, settings, adjRMSDcutoff,
+                  streamed=None):
+
+    #With settings.StreamPrune the conformers are pruned as they are read,
+    #or were already pruned while the search ran if streamed is given
+    if not (settings.StreamPrune and settings.ConfPrune) or settings.MMTinker:
+        streamed = None
+    elif streamed is None:
+        import MacroModel
+        streamed = MacroModel.StreamPruneMae(MMoutp, adjRMSDcutoff, settings)
+
+    #As with the full ensemble, only prune if the number exceeds the limit
+    if streamed is not None and streamed.Seen() <= settings.PerStructConfLimit:
+        streamed = None
+
+    if streamed is not None:
+        pruned = streamed.Ensemble(Conformers.CoordType(settings))
+        atoms = streamed.atoms
+        charge = streamed.charge
+        nconfs = streamed.Seen()
+        actualRMSDcutoff = streamed.cutoff
         if len(pruned) > settings.PerStructConfLimit and settings.StrictConfLimit:
-            pruned, actualRMSDcutoff = ConfPrune.StrictRMSDPrune(conformers, atoms, adjRMSDcutoff,
-                                               settings.PerStructConfLimit)
-    else:
-        pruned = conformers
-        actualRMSDcutoff = adjRMSDcutoff
+            print str(len(pruned)) + " conformers left by stream pruning, " +\
+                "pruning the full ensemble to enforce the conformer limit"
+            streamed = None
+        elif settings.charge is not None:
+            charge = settings.charge
+
+    if streamed is None:
+        #Reads conformer geometry, energies and atom labels from the MM output
+        (atoms, conformers, charge) = Conformers.ReadConformers(MMoutp, settings)
+        if settings.charge is not None:
+            charge = settings.charge
+        nconfs = len(conformers)
+
+        #Prune similar conformations, if the number exceeds the limit
+        if len(conformers) > settings.PerStructConfLimit and settings.ConfPrune:
+            RMSDCache = Conformers.RMSDCacheFile(MMoutp, settings)
+            pruned = ConfPrune.RMSDPrune(conformers, atoms, adjRMSDcutoff,
+                                         RMSDCache, settings)
+            actualRMSDcutoff = adjRMSDcutoff
+            if len(pruned) > settings.PerStructConfLimit and settings.StrictConfLimit:
+                pruned, actualRMSDcutoff = ConfPrune.StrictRMSDPrune(conformers, atoms, adjRMSDcutoff,
+                                                   settings.PerStructConfLimit, RMSDCache,
+                                                   settings)
+        else:
+            pruned = conformers
+            actualRMSDcutoff = adjRMSDcutoff
 
     if settings.ConfPrune:
-        print str(len(conformers) - len(pruned)) +\
-            " or " + "{:.1f}".format(100*(len(conformers) - len(pruned)) /
-            len(conformers))+"% of conformations have been pruned based on " +\
+        print str(nconfs - len(pruned)) +\
+            " or " + "{:.1f}".format(100*(nconfs - len(pruned)) /
+            nconfs)+"% of conformations have been pruned based on " +\
             str(actualRMSDcutoff) + " angstrom cutoff"
     
     if not settings.PM7Opt:
@@ -93,85 +121,54 @@ def SetupGaussian(MMoutp, Gausinp, numDigits, settings, adjRMSDcutoff):
 
 def SetupGaussianCluster(MMoutp, Gausinp, numDigits, settings):
 
-    if settings.MMTinker:
-        print "Clustering not implemented with Tinker..."
-        quit()
-    else:
-        atoms, conformers, charge, AbsEs = MacroModel.ReadMacromodel(MMoutp,
-                                                                settings)
+    res = Conformers.ReadConformers(MMoutp, settings)
+    atoms, conformers, charge = res[:3]
     if settings.charge is not None:
         charge = settings.charge
 
-    oldconformers = conformers
-    conformers = AdaptConfs(conformers)
-    print str(len(conformers)) + " Macromodel conformers read"
+    coords = numpy.asarray(conformers.coords, dtype=numpy.float64)
+    print str(len(conformers)) + " MM conformers read"
 
+    AbsEs = conformers.energies
     print "Absolute energies: " + ', '.join([format(x, "3.1f") for x in AbsEs])
-    MinE = min(AbsEs)
-    RelEs = [x-MinE for x in AbsEs]
-    print "Relative energies " + ', '.join([format(x-MinE, "3.1f") for x in AbsEs])
+    RelEs = AbsEs - AbsEs.min()
+    print "Relative energies " + ', '.join([format(x, "3.1f") for x in RelEs])
 
-    obmols = BuildObMols(conformers, atoms)
-    IntCoords = SelectCoords(obmols[0])
+    #The connectivity is the same in all conformers, so it is only
+    #perceived for the first one
+    obmol = BuildOBMol(atoms, coords[0])
+    IntCoords = SelectCoords(obmol)
     print str(len(IntCoords)) + " torsionable single bonds found"
     print IntCoords
 
-    CoordData = GetCoordData(obmols, IntCoords)
+    CoordData = GetCoordData(coords, IntCoords)
     for data in CoordData[:3]:
         print ' '.join([format(x, "8.1f") for x in data])
     print '-'*20
 
-    import hdbscan
-
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=4, min_samples=1)
-
-    clusterer.fit(CoordData)
-    #clusterer.fit(TSNEdata)
-    print "Number of clusters: " + str(max(clusterer.labels_)+1)
+    labels, MinEconfs = ConfCluster.ClusterConformers(CoordData, RelEs,
+                                                      settings)
+    print "Number of clusters: " + str(len(MinEconfs))
     print "Clustering results: "
-    print clusterer.labels_
+    print labels
 
-    Clusters = []
-    MinEconfs = []
-    for i in range(-1, max(clusterer.labels_)):
-        Clusters.append([j for j, x in enumerate(clusterer.labels_) if x == i])
-
-    for i, cluster in enumerate(Clusters):
-        MinE = 1000
-        tempmin = 10000
-        for x in cluster:
-            if RelEs[x] < MinE:
-                tempmin = x
-                MinE = RelEs[x]
-        if tempmin != 10000:
-            MinEconfs.append(tempmin)
-        #MinE = min([filtRelEs[x] for x in cluster])
-        print "Cluster " + str(i) + ": " + str(cluster) + ", min E: " + format(MinE, ".1f") + ' kJ/mol (' + str(tempmin) + ')'
-
-    print MinEconfs
+    for cluster, minconf in zip(ConfCluster.ClusterMembers(labels),
+                                MinEconfs):
+        print "Cluster " + str(labels[minconf]) + ": " + str(list(cluster)) +\
+            ", min E: " + format(RelEs[minconf], ".1f") + ' kJ/mol (' +\
+            str(minconf) + ')'
 
+    print list(MinEconfs)
 
     for num in MinEconfs:
         filename = Gausinp + str(num + 1).zfill(3)
         if (not settings.DFTOpt) and (not settings.PM6Opt) and (not settings.HFOpt) \
                 and (not settings.M06Opt):
-            WriteGausFile(filename, oldconformers[num], atoms, charge, settings)
+            WriteGausFile(filename, conformers[num], atoms, charge, settings)
 
     print str(len(MinEconfs)) + " .com files written"
 
 
-def BuildObMols(conformers, atoms):
-    obmols = []
-
-    for conf in conformers:
-        mol = BuildOBMol(atoms, conf)
-        obmols.append(mol)
-
-    print str(len(obmols)) + " obmols generated"
-
-    return obmols
-
-
 def BuildOBMol(atoms, coords):
 
     mol = OBMol()
@@ -190,19 +187,6 @@ def BuildOBMol(atoms, coords):
     return mol
 
 
-def AdaptConfs(conformers):
-
-    newconfs = []
-
-    for conf in conformers:
-        newconf = []
-        for coord in conf:
-            newconf.append([float(x) for x in coord[1:]])
-        newconfs.append(newconf)
-
-    return newconfs
-
-
 def SelectCoords(mol):
 
     TorsAtoms = []
@@ -221,32 +205,62 @@ def SelectCoords(mol):
     return TorsAtoms
 
 
-def GetCoordData(obmols, TorsAtoms, ExtraCoords = []):
-    coords = []
+"""
+Internal coordinates of all conformers in one pass over the (nconf, natoms,
+3) coordinate array. TorsAtoms lists torsions and ExtraCoords distances,
+angles or torsions as 2, 3 or 4 atom indices, 1-based as in OpenBabel.
+Angles and torsions are in degrees, following OBMol.GetAngle and
+OBMol.GetTorsion. Returns a (nconf, ncoords) array, torsions first.
+"""
+def GetCoordData(coords, TorsAtoms, ExtraCoords = []):
+
+    IntCoords = list(TorsAtoms) + list(ExtraCoords)
+    data = numpy.zeros((len(coords), len(IntCoords)))
+
+    for n, func in [(2, Distances), (3, Angles), (4, Torsions)]:
+        cols = [i for i, coord in enumerate(IntCoords) if len(coord) == n]
+        if len(cols) > 0:
+            idx = numpy.array([IntCoords[i] for i in cols]) - 1
+            data[:, cols] = func(*[coords[:, idx[:, k]] for k in range(n)])
+
+    return data
 
-    for mol in obmols:
-        moldata = []
-        for tors in TorsAtoms:
-            moldata.append(mol.GetTorsion(tors[0], tors[1], tors[2], tors[3]))
 
-        if len(ExtraCoords) > 0:
-            for coord in ExtraCoords:
-                if len(coord) == 2:
-                    moldata.append(GetDistance(mol, coord))
-                elif len(coord) == 3:
-                    moldata.append(mol.GetAngle(coord[0], coord[1], coord[2]))
-                elif len(coord) == 4:
-                    moldata.append(mol.GetTorsion(coord[0], coord[1], coord[2], coord[3]))
+def Distances(a, b):
 
-        coords.append(moldata)
+    return numpy.sqrt(((a - b)**2).sum(axis=-1))
 
-    return coords
 
-def GetDistance(mol, atoms):
+def Angles(a, b, c):
 
-    a1 = mol.GetAtom(atoms[0])
+    return VectorAngles(a - b, c - b)
 
-    return a1.GetDistance(atoms[1])
+
+#Torsion angles a-b-c-d, 0 if either plane is undefined
+def Torsions(a, b, c, d):
+
+    b1 = a - b
+    b2 = b - c
+    b3 = c - d
+    c1 = numpy.cross(b1, b2)
+    c2 = numpy.cross(b2, b3)
+    c3 = numpy.cross(c1, c2)
+
+    torsions = VectorAngles(c1, c2)
+    torsions[((b2*c3).sum(axis=-1)) > 0.0] *= -1.0
+    norms = numpy.sqrt((c1**2).sum(axis=-1)*(c2**2).sum(axis=-1))
+    torsions[norms < 0.001] = 0.0
+
+    return torsions
+
+
+#Angles between the vectors in degrees
+def VectorAngles(u, v):
+
+    norms = numpy.sqrt((u**2).sum(axis=-1)*(v**2).sum(axis=-1))
+    cosines = (u*v).sum(axis=-1)/numpy.where(norms > 0.0, norms, 1.0)
+
+    return numpy.degrees(numpy.arccos(numpy.clip(cosines, -1.0, 1.0)))
 
 
 def IsTerminating(bond):
@@ -302,16 +316,14 @@ def ChooseTorsAtoms(bond):
 #Adjust the RMSD cutoff to keep the conformation numbers reasonable
 def AdaptiveRMSD(MMoutp, settings):
 
-    if settings.MMTinker:
-        #Reads conformer geometry, energies and atom labels from Tinker output
-        (atoms, conformers, charge) = Tinker.ReadTinker(MMoutp, settings)
-    else:
-        (atoms, conformers, charge) = MacroModel.ReadMacromodel(MMoutp,
-                                                                settings)
+    #Reads conformer geometry, energies and atom labels from the MM output
+    (atoms, conformers, charge) = Conformers.ReadConformers(MMoutp, settings)
 
     return ConfPrune.AdaptRMSDPrune(conformers, atoms,
                                     settings.InitialRMSDcutoff,
-                                    settings.PerStructConfLimit)
+                                    settings.PerStructConfLimit,
+                                    Conformers.RMSDCacheFile(MMoutp, settings),
+                                    settings)
 
 
 def PM7opt(Gausinp, conformer, atoms, charge, settings):
@@ -609,198 +621,235 @@ def RunLocally(GausJobs, settings):
             " completed."
 
 
-#Still need addition of support for geometry optimisation
-def RunOnZiggy(findex, queue, GausFiles, settings):
+#Runs the Gaussian jobs on ziggy, settings.MaxConcurrentJobs at a time,
+#in one job folder named after the start time and title
+def RunOnZiggy(queue, GausFiles, settings):
 
-    if findex == 0:
-        folder = settings.StartTime + settings.Title
+    print "ziggy GAUSSIAN job submission script\n"
+
+    backend = ZiggyQueue(queue, settings.StartTime + settings.Title, settings)
+    if settings.JobArray:
+        #The array throttle limits the running jobs, the scheduler only
+        #follows their progress
+        JobScheduler.RunJobs(GausFiles, backend, len(GausFiles))
     else:
-        folder = settings.StartTime + findex + settings.Title
+        JobScheduler.RunJobs(GausFiles, backend, settings.MaxConcurrentJobs)
 
-    scrfolder = settings.StartTime + settings.Title
 
-    print "ziggy GAUSSIAN job submission script\n"
+#Gaussian jobs on the ziggy slurm queue, one slurm script per job
+class ZiggyQueue:
 
-    #Check that folder does not exist, create job folder on ziggy
-    outp = subprocess.check_output('ssh ziggy ls', shell=True)
-    if folder in outp:
-        print "Folder exists on ziggy, choose another folder name."
-        return
+    interval = 60
 
-    outp = subprocess.check_output('ssh ziggy mkdir ' + folder, shell=True)
+    def __init__(self, queue, folder, settings):
+        self.queue = queue
+        self.folder = folder
+        self.settings = settings
+        self.ziggy = Transport.GetTransport('ziggy', settings)
 
-    print "Results folder: " + folder
+    def Start(self, jobs):
 
-    #Write the qsub scripts
-    for f in GausFiles:
-        if (not settings.DFTOpt) and (not settings.PM6Opt) and (not settings.HFOpt)\
-            and (not settings.M06Opt):
-            WriteSubScript(f[:-4], queue, folder, settings)
+        #Check that folder does not exist, create job folder on ziggy
+        outp = self.ziggy.Run('ls')
+        if self.folder in outp.split():
+            print "Folder exists on ziggy, choose another folder name."
+            return False
+
+        outp = self.ziggy.Run('mkdir ' + self.folder)
+
+        print "Results folder: " + self.folder
+
+        #With settings.JobArray all jobs are one slurm job array, submitted
+        #here, that runs the jobs listed in a manifest
+        if self.settings.JobArray:
+            files = []
+            for f in jobs:
+                files.extend(GausInputs(f, self.settings))
+            files.extend(WriteArrayScript(jobs, self.queue, self.settings))
+        elif self.settings.BulkTransfer:
+            files = []
+            for f in jobs:
+                files.extend(self.WriteJob(f))
+
+        #With settings.BulkTransfer all inputs go up in one archive
+        if self.settings.BulkTransfer:
+            self.ziggy.PutArchive(files, self.folder,
+                                  self.settings.BulkCompress)
+            print str(len(jobs)) + ' jobs uploaded to ziggy'
+        elif self.settings.JobArray:
+            self.ziggy.Put(files, '~/' + self.folder)
+
+        if self.settings.JobArray:
+            outp = self.ziggy.Run('cd ' + self.folder + ' && sbatch ' +
+                                  files[-1])
+            print outp.strip()
+
+    def Submit(self, f):
+
+        if self.settings.JobArray:
+            return
+
+        if not self.settings.BulkTransfer:
+            self.ziggy.Put(self.WriteJob(f), '~/' + self.folder)
+
+        #Launch the calculation
+        job = '~/' + self.folder + '/' + f[:-4]
+        outp = self.ziggy.Run('sbatch ' + job + 'slurm')
+
+    def Completed(self, jobs):
+        JobFinished = IsZiggyGComplete([job[:-3] + 'out' for job in jobs],
+                                       self.folder, self.settings)
+        return [job for job in jobs if JobFinished[job[:-3] + 'out']]
+
+    def Finish(self):
+
+        #When done, copy the results back
+        print "\nCopying the output files back to localhost..."
+        if self.settings.BulkTransfer:
+            self.ziggy.GetArchive(['*.out'], self.folder, os.getcwd(),
+                                  self.settings.BulkCompress)
         else:
-            WriteSubScriptOpt(f[:-4], queue, folder, settings)
-    print str(len(GausFiles)) + ' slurm scripts generated'
+            self.ziggy.Get(['~/' + self.folder + '/*.out'], os.getcwd())
+
+    #Writes the slurm script of a job, returns the files to upload for it
+    def WriteJob(self, f):
 
-    #Upload .com files and .qsub files to directory
-    print "Uploading files to ziggy..."
-    for f in GausFiles:
+        settings = self.settings
         if (not settings.DFTOpt) and (not settings.PM6Opt) and (not settings.HFOpt)\
             and (not settings.M06Opt):
-            outp = subprocess.check_output('scp ' + f +' ziggy:~/' + folder,
-                                           shell=True)
+            WriteSubScript(f[:-4], self.queue, self.folder, settings)
         else:
-            outp = subprocess.check_output('scp ' + f[:-4] +'a.com ziggy:~/' +
-                                           folder, shell=True)
-            outp = subprocess.check_output('scp ' + f[:-4] +'b.com ziggy:~/' +
-                                           folder, shell=True)
-        outp = subprocess.check_output('scp ' + f[:-4] +'slurm ziggy:~/' +
-                                       folder, shell=True)
-
-    print str(len(GausFiles)) + ' .com and slurm files uploaded to ziggy'
-
-    #Launch the calculations
-    for f in GausFiles:
-        job = '~/' + folder + '/' + f[:-4]
-        outp = subprocess.check_output('ssh ziggy sbatch ' + job + 'slurm', shell=True)
-
-    print str(len(GausFiles)) + ' jobs submitted to the queue on ziggy'
-
-    outp = subprocess.check_output('ssh ziggy qstat', shell=True)
-    if settings.user in outp:
-        print "Jobs are running on ziggy"
-
-    Jobs2Complete = list(GausFiles)
-    n2complete = len(Jobs2Complete)
-
-    #Check and report on the progress of calculations
-    while len(Jobs2Complete) > 0:
-        JustCompleted = [job for job in Jobs2Complete if
-            IsZiggyGComplete(job[:-3] + 'out', folder, settings)]
-        Jobs2Complete[:] = [job for job in Jobs2Complete if
-             not IsZiggyGComplete(job[:-3] + 'out', folder, settings)]
-        if n2complete != len(Jobs2Complete):
-            n2complete = len(Jobs2Complete)
-            print str(n2complete) + " remaining."
-
-        time.sleep(60)
-
-    #When done, copy the results back
-    print "\nCopying the output files back to localhost..."
-    print 'ssh ziggy scp /home/' + settings.user + '/' + folder + '/*.out ' +\
-        socket.getfqdn() + ':' + os.getcwd()
-    outp = subprocess.check_output('ssh ziggy scp /home/' + settings.user +
-                                   '/' + folder + '/*.out ' + socket.getfqdn()
-                                   + ':' + os.getcwd(), shell=True)
-
-def RunOnDarwin(findex, GausJobs, settings):
-
-    if findex == 0:
-        folder = settings.StartTime + settings.Title
+            WriteSubScriptOpt(f[:-4], self.queue, self.folder, settings)
+
+        return GausInputs(f, settings) + [f[:-4] + 'slurm']
+
+
+#Input files of a Gaussian job, the a.com/b.com pair for optimisations
+def GausInputs(f, settings):
+
+    if (not settings.DFTOpt) and (not settings.PM6Opt) and (not settings.HFOpt)\
+        and (not settings.M06Opt):
+        return [f]
     else:
-        folder = settings.StartTime + findex + settings.Title
+        return [f[:-4] + 'a.com', f[:-4] + 'b.com']
+
 
-    scrfolder = settings.StartTime + settings.Title
+#Runs the Gaussian jobs on darwin in node sized slurm scripts, keeping up to
+#settings.MaxConcurrentJobsDarwin Gaussian jobs in the queue at once
+def RunOnDarwin(GausJobs, settings):
 
     print "Darwin GAUSSIAN job submission script\n"
-    
-    #Check that results folder does not exist, create job folder on darwin
-    outp = subprocess.Popen(['ssh', 'darwin', 'ls'], \
-      stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
-    print "Results folder: " + folder
-    
-    if folder in outp:
-        print "Results folder exists on Darwin, choose another folder name."
-        quit()
 
-    outp = subprocess.Popen(['ssh', 'darwin', 'mkdir', folder], \
-      stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
+    backend = DarwinQueue(GausJobs, settings.StartTime + settings.Title,
+                          settings)
+    AdjNodeSize = int(math.floor(settings.DarwinNodeSize/settings.nProc))
+    JobScheduler.RunJobs(backend.SubFiles, backend,
+                         max(1, settings.MaxConcurrentJobsDarwin//AdjNodeSize))
 
-    # Check that scratch directory does not exist, create job folder on darwin
-    outp = subprocess.Popen(['ssh', 'darwin', 'ls ' + settings.DarwinScrDir], \
-                            stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
-    print "Scratch directory: " + settings.DarwinScrDir + scrfolder
 
-    if folder in outp:
-        print "Scratch folder exists on Darwin, choose another folder name."
-        quit()
+#Gaussian jobs on the darwin slurm queue. The jobs of the scheduler are the
+#node sized slurm scripts written by WriteDarwinScripts, each running a
+#share of the Gaussian jobs
+class DarwinQueue:
 
-    outp = subprocess.Popen(['ssh', 'darwin', 'mkdir', settings.DarwinScrDir + scrfolder], \
-                            stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
+    interval = 180
 
-    #Write the slurm scripts
-    SubFiles = WriteDarwinScripts(GausJobs, settings, scrfolder)
-        
-    print str(len(SubFiles)) + ' slurm scripts generated'
+    def __init__(self, GausJobs, folder, settings):
 
-    #Upload .com files and slurm files to directory
-    print "Uploading files to darwin..."
-    for f in GausJobs:
-        if (not settings.DFTOpt) and (not settings.PM6Opt) and (not settings.HFOpt)\
-            and (not settings.M06Opt):
-            outp = subprocess.Popen(['scp', f,
-            'darwin:/home/' + settings.user + '/' + folder],
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
-        
-        else:
-            outp = subprocess.Popen(['scp', f[:-4] + 'a.com',
-                'darwin:/home/' + settings.user + '/' + folder],
-                stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
-            outp = subprocess.Popen(['scp', f[:-4] + 'b.com',
-                'darwin:/home/' + settings.user + '/' + folder],
-                stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
-    
-    for f in SubFiles:
-        
-        outp = subprocess.Popen(['scp', f,
-            'darwin:/home/' + settings.user + '/' + folder], \
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
+        self.folder = folder
+        self.scrfolder = settings.StartTime + settings.Title
+        self.settings = settings
+        self.darwin = Transport.GetTransport('darwin', settings)
 
-    print str(len(GausJobs)) + ' .com and ' + str(len(SubFiles)) +\
-        ' slurm files uploaded to darwin'
-    
-    fullfolder = '/home/' + settings.user + '/' + folder
-    #Launch the calculations
-    for f in SubFiles:
-        outp = subprocess.Popen(['ssh', 'darwin', 'cd ' + fullfolder + ';sbatch', f], \
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
+        #Write the slurm scripts
+        self.SubFiles = WriteDarwinScripts(GausJobs, settings, self.scrfolder)
+        print str(len(self.SubFiles)) + ' slurm scripts generated'
+
+        AdjNodeSize = int(math.floor(settings.DarwinNodeSize/settings.nProc))
+        self.ScriptJobs = {}
+        for i, f in enumerate(self.SubFiles):
+            self.ScriptJobs[f] = list(GausJobs[i*AdjNodeSize:(i+1)*AdjNodeSize])
+
+    def Start(self, SubFiles):
+
+        settings = self.settings
+        folder = self.folder
+
+        #Check that results folder does not exist, create job folder on darwin
+        outp = self.darwin.Run('ls', False)
+        print "Results folder: " + folder
+
+        if folder in outp.split():
+            print "Results folder exists on Darwin, choose another folder name."
+            quit()
+
+        outp = self.darwin.Run('mkdir ' + folder, False)
+
+        # Check that scratch directory does not exist, create job folder on darwin
+        outp = self.darwin.Run('ls ' + settings.DarwinScrDir, False)
+        print "Scratch directory: " + settings.DarwinScrDir + self.scrfolder
+
+        if self.scrfolder in outp.split():
+            print "Scratch folder exists on Darwin, choose another folder name."
+            quit()
+
+        outp = self.darwin.Run('mkdir ' + settings.DarwinScrDir + self.scrfolder,
+                               False)
+
+        #With settings.BulkTransfer all inputs go up in one archive
+        if settings.BulkTransfer:
+            files = []
+            for SubFile in SubFiles:
+                files.extend(self.JobFiles(SubFile))
+            self.darwin.PutArchive(files, folder, settings.BulkCompress)
+            print str(len(SubFiles)) + ' slurm scripts and their inputs ' +\
+                'uploaded to darwin'
+
+    def Submit(self, SubFile):
+
+        #Upload the .com files and the slurm file to the job folder
+        if not self.settings.BulkTransfer:
+            self.darwin.Put(self.JobFiles(SubFile), '~/' + self.folder)
+
+        #Launch the calculations
+        outp = self.darwin.Run('cd ' + self.folder + ';sbatch ' + SubFile,
+                               False)
         print outp.split('\n')[-2]
 
-    print str(len(SubFiles)) + ' jobs submitted to the queue on darwin ' + \
-        'containing ' + str(len(GausJobs)) + ' Gaussian jobs'
-    
-    Jobs2Complete = list(GausJobs)
-    n2complete = len(Jobs2Complete)
-    
-    #Check and report on the progress of calculations
-    while len(Jobs2Complete) > 0:
-        JobFinished = IsDarwinGComplete(Jobs2Complete, folder, settings)
-        
-        Jobs2Complete[:] = [job for job in Jobs2Complete if
-             not JobFinished[job[:-3] + 'out']]
-        if n2complete != len(Jobs2Complete):
-            n2complete = len(Jobs2Complete)
-            print str(n2complete) + " remaining."
-
-        time.sleep(180)
-
-    #When done, copy the results back
-    print "\nCopying the output files back to localhost..."
-    print 'scp darwin:' + fullfolder + '/*.out ' + os.getcwd() + '/'
-    #outp = subprocess.check_output('ssh darwin scp /home/' + settings.user +
-    #                               '/' + folder + '/*.out ' + socket.getfqdn()
-    #                               + ':' + os.getcwd(), shell=True)
-        
-    outp = subprocess.Popen(['scp', 'darwin:' + fullfolder + '/*.out ',
-            os.getcwd() + '/'], \
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
-
-    fullscrfolder = settings.DarwinScrDir + scrfolder
-    print "\nDeleting scratch folder..."
-    print 'ssh darwin rm -r ' + fullscrfolder
-    #outp = subprocess.check_output('ssh darwin rm /home/' + settings.user +
-    #                               '/' + folder + '/*.chk', shell=True)
-    outp = subprocess.Popen(['ssh', 'darwin', 'rm -r', fullscrfolder], \
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
-    
+    def Completed(self, SubFiles):
+
+        GausJobs = []
+        for f in SubFiles:
+            GausJobs.extend(self.ScriptJobs[f])
+        JobFinished = IsDarwinGComplete(GausJobs, self.folder, self.settings)
+
+        return [f for f in SubFiles if
+                all([JobFinished[job[:-3] + 'out'] for job in self.ScriptJobs[f]])]
+
+    def Finish(self):
+
+        #When done, copy the results back
+        print "\nCopying the output files back to localhost..."
+        if self.settings.BulkTransfer:
+            self.darwin.GetArchive(['*.out'], self.folder, os.getcwd(),
+                                   self.settings.BulkCompress)
+        else:
+            self.darwin.Get(['~/' + self.folder + '/*.out'], os.getcwd())
+
+        fullscrfolder = self.settings.DarwinScrDir + self.scrfolder
+        print "\nDeleting scratch folder..."
+        print 'ssh darwin rm -r ' + fullscrfolder
+        outp = self.darwin.Run('rm -r ' + fullscrfolder, False)
+
+    #The .com files of a slurm script and the script itself
+    def JobFiles(self, SubFile):
+
+        files = []
+        for f in self.ScriptJobs[SubFile]:
+            files.extend(GausInputs(f, self.settings))
+
+        return files + [SubFile]
+
 
 def WriteDarwinScripts(GausJobs, settings, scrfolder):
 
@@ -872,20 +921,18 @@ def WriteSlurm(GausJobs, settings, scrfolder, index=''):
     return filename
 
 
+#Checks which of the Gaussian jobs on darwin have terminated normally,
+#with one remote command for all of them
 def IsDarwinGComplete(GausJobs, folder, settings):
 
-    path = '/home/' + settings.user + '/' + folder + '/'
+    outfiles = [f[:-3] + 'out' for f in GausJobs]
+    tails = JobScheduler.OutputTails(outfiles, folder,
+                                     Transport.GetTransport('darwin', settings),
+                                     90)
+
     results = {}
-    
-    for f in GausJobs:
-        outp = subprocess.Popen(['ssh', 'darwin', 'cat', path + f[:-3] + 'out'], \
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE).communicate()[0]
-        #outp = subprocess.check_output('ssh darwin cat ' + path + f,
-        #                                    shell=True)
-        if "Normal termination" in outp[-90:]:
-            results[f[:-3] + 'out'] = True
-        else:
-            results[f[:-3] + 'out'] = False
+    for f in outfiles:
+        results[f] = "Normal termination" in tails.get(f, '')
     
     return results
 
@@ -1006,24 +1053,110 @@ def WriteSubScriptOpt(GausJob, queue, ZiggyJobFolder, settings):
     QSub.close()
 
 
-def IsZiggyGComplete(f, folder, settings):
+"""
+Writes a slurm job array script for all Gaussian jobs on ziggy and the
+manifest it reads them from, one job name per line. Array task i runs the
+job on line i of the manifest, with the same setup as the per job scripts
+of WriteSubScript and WriteSubScriptOpt. At most settings.ArrayThrottle
+tasks run at once, or settings.MaxConcurrentJobs if that is 0. The script
+is submitted from the job folder, which is where its tasks find the inputs.
+Returns the manifest and script file names.
+"""
+def WriteArrayScript(GausJobs, queue, settings):
+
+    manifest = settings.Title + 'manifest'
+    script = settings.Title + 'array.slurm'
+
+    Mfile = open(manifest, 'w')
+    Mfile.write(''.join([f[:-4] + '\n' for f in GausJobs]))
+    Mfile.close()
 
-    path = '/home/' + settings.user + '/' + folder + '/'
-    try:
-        outp1 = subprocess.check_output('ssh ziggy ls ' + path, shell=True)
-    except subprocess.CalledProcessError, e:
-        print "ssh ziggy ls failed: " + str(e.output)
-        return False
-    if f in outp1:
-        try:
-            outp2 = subprocess.check_output('ssh ziggy cat ' + path + f,
-                                            shell=True)
-        except subprocess.CalledProcessError, e:
-            print "ssh ziggy cat failed: " + str(e.output)
-            return False
-        if "Normal termination" in outp2[-90:]:
-            return True
-    return False
+    throttle = settings.ArrayThrottle
+    if throttle <= 0:
+        throttle = settings.MaxConcurrentJobs
+
+    opt = settings.DFTOpt or settings.PM6Opt or settings.HFOpt or \
+        settings.M06Opt
+
+    #Create the submission script
+    QSub = open(script, 'w')
+
+    #Choose the queue
+    QSub.write('#!/bin/bash\n\n')
+    QSub.write('#SBATCH -p SWAN\n')
+    QSub.write('#SBATCH --nodes=1\n#SBATCH --cpus-per-task=' +
+               str(max(1, settings.nProc)) + '\n')
+    QSub.write('#SBATCH --time=' + format(settings.TimeLimit,"02") +':00:00\n')
+    QSub.write('#SBATCH --array=1-' + str(len(GausJobs)) + '%' +
+               str(throttle) + '\n\n')
+
+    #define input files and output files from the manifest line of the task
+    QSub.write('HERE=$SLURM_SUBMIT_DIR\n')
+    QSub.write('file=$(sed -n "${SLURM_ARRAY_TASK_ID}p" $HERE/' + manifest +
+               ')\n\n')
+    if not opt:
+        QSub.write('inpfile=${file}.com\noutfile=${file}.out\n')
+    else:
+        QSub.write('inpfile1=${file}a.com\ninpfile2=${file}b.com\n')
+        QSub.write('outfile1=${file}temp.out\noutfile2=${file}.out\n')
+
+    #define scratch folder and ask the machine
+    #to make it before running the job
+    QSub.write('SCRATCH=/scratch/' + settings.user + '/${file}\n')
+    QSub.write('mkdir ${SCRATCH}\n')
+
+    #Setup GAUSSIAN environment variables
+    QSub.write('set OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK\n')
+
+    QSub.write('export GAUSS_EXEDIR=/usr/local/shared/gaussian/em64t/09-D01/g09\n')
+    QSub.write('export g09root=/usr/local/shared/gaussian/em64t/09-D01\n')
+    QSub.write('export PATH=/usr/local/shared/gaussian/em64t/09-D01/g09:$PATH\n')
+    QSub.write('export GAUSS_SCRDIR=$SCRATCH\n')
+    QSub.write('exe=$GAUSS_EXEDIR/g09\n')
+
+    #copy the input files to scratch
+    if not opt:
+        QSub.write('cp ${HERE}/${inpfile}  $SCRATCH\ncd $SCRATCH\n')
+    else:
+        QSub.write('cp ${HERE}/${inpfile1}  $SCRATCH\n')
+        QSub.write('cp ${HERE}/${inpfile2}  $SCRATCH\ncd $SCRATCH\n')
+
+    #write useful info to the job output file (not the gaussian)
+    QSub.write('echo "Starting task $SLURM_ARRAY_TASK_ID of job ' +
+               '$SLURM_ARRAY_JOB_ID: $file"\necho\n')
+    QSub.write('echo "SLURM assigned me this node:"\nsrun hostname\necho\n')
+
+    if not opt:
+        QSub.write('ln -s $HERE/$outfile $SCRATCH/$outfile\n')
+        QSub.write('srun $exe > $outfile < $inpfile\n')
+    else:
+        QSub.write('ln -s $HERE/$outfile1 $SCRATCH/$outfile1\n')
+        QSub.write('ln -s $HERE/$outfile2 $SCRATCH/$outfile2\n')
+        QSub.write('srun $exe < $inpfile1 > $outfile1\n')
+        QSub.write('wait\n')
+        QSub.write('srun $exe < $inpfile2 > $outfile2\n')
+
+    #Cleanup
+    QSub.write('rm -rf ${SCRATCH}/\n')
+
+    QSub.close()
+
+    return [manifest, script]
+
+
+#Checks which of the Gaussian outputs on ziggy have terminated normally,
+#with one remote command for all of them
+def IsZiggyGComplete(outfiles, folder, settings):
+
+    tails = JobScheduler.OutputTails(outfiles, folder,
+                                     Transport.GetTransport('ziggy', settings),
+                                     90)
+
+    results = {}
+    for f in outfiles:
+        results[f] = "Normal termination" in tails.get(f, '')
+
+    return results
 
 
 def CheckConvergence(inpfiles):
@@ -4,8 +4,7 @@ Created on Thu Oct 16 14:26:32 2015
 
 @author: kristaps
 """
-import Tinker
-import MacroModel
+import Conformers
 import nmrPredictJag
 
 import subprocess
@@ -31,22 +30,21 @@ and submission to DP4
 
 def SetupJaguar(MMoutp, Jaginp, numDigits, settings, adjRMSDcutoff):
 
-    if settings.MMTinker:
-        #Reads conformer geometry, energies and atom labels from Tinker output
-        (atoms, conformers, charge) = Tinker.ReadTinker(MMoutp, settings)
-    else:
-        (atoms, conformers, charge) = MacroModel.ReadMacromodel(MMoutp,
-                                                                settings)
+    #Reads conformer geometry, energies and atom labels from the MM output
+    (atoms, conformers, charge) = Conformers.ReadConformers(MMoutp, settings)
     if settings.charge is not None:
         charge = settings.charge
 
     #Prune similar conformations, if the number exceeds the limit
     if len(conformers) > settings.PerStructConfLimit and settings.ConfPrune:
-        pruned = ConfPrune.RMSDPrune(conformers, atoms, adjRMSDcutoff)
+        RMSDCache = Conformers.RMSDCacheFile(MMoutp, settings)
+        pruned = ConfPrune.RMSDPrune(conformers, atoms, adjRMSDcutoff,
+                                     RMSDCache, settings)
         actualRMSDcutoff = adjRMSDcutoff
         if len(pruned) > settings.PerStructConfLimit and settings.StrictConfLimit:
             pruned, actualRMSDcutoff = ConfPrune.StrictRMSDPrune(conformers, atoms, adjRMSDcutoff,
-                                               settings.PerStructConfLimit)
+                                               settings.PerStructConfLimit, RMSDCache,
+                                               settings)
     else:
         pruned = conformers
         actualRMSDcutoff = adjRMSDcutoff
@@ -67,16 +65,14 @@ def SetupJaguar(MMoutp, Jaginp, numDigits, settings, adjRMSDcutoff):
 #Adjust the RMSD cutoff to keep the conformation numbers reasonable
 def AdaptiveRMSD(MMoutp, settings):
 
-    if settings.MMTinker:
-        #Reads conformer geometry, energies and atom labels from Tinker output
-        (atoms, conformers, charge) = Tinker.ReadTinker(MMoutp, settings)
-    else:
-        (atoms, conformers, charge) = MacroModel.ReadMacromodel(MMoutp,
-                                                                settings)
+    #Reads conformer geometry, energies and atom labels from the MM output
+    (atoms, conformers, charge) = Conformers.ReadConformers(MMoutp, settings)
 
     return ConfPrune.AdaptRMSDPrune(conformers, atoms,
                                     settings.InitialRMSDcutoff,
-                                    settings.PerStructConfLimit)
+                                    settings.PerStructConfLimit,
+                                    Conformers.RMSDCacheFile(MMoutp, settings),
+                                    settings)
 
 
 
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:05:31 2026
+
+@author: ke291
+
+Rolling-window execution of DFT jobs on a cluster queue. The queue specific
+parts are backend classes in Gaussian.py and NWChem.py, LocalQueue stands
+in for a cluster when testing. Called by Gaussian.py and NWChem.py.
+"""
+
+import os
+import pipes
+import re
+import subprocess
+import sys
+import time
+
+#Line written before the tail of every output by OutputTails
+TailMarker = '==PyDP4 tail== '
+
+
+"""
+Runs jobs through a queue backend, keeping up to maxjobs of them submitted
+at any time. As soon as a poll finds finished jobs, the next jobs are
+submitted in their place, so a slow job only holds its own slot instead of
+a whole batch.
+
+The backend provides:
+Start(jobs)     - called once with all jobs before the first submission,
+                  eg. to create the job folder, returns False if the jobs
+                  can't be run
+Submit(job)     - submits one job
+Completed(jobs) - returns the jobs of the list that have finished
+Finish()        - called once after all jobs have finished, eg. to copy
+                  the results back
+interval        - seconds between polls
+
+Returns False if the backend could not be started, True otherwise.
+"""
+def RunJobs(jobs, backend, maxjobs):
+
+    if backend.Start(list(jobs)) is False:
+        return False
+
+    pending = list(jobs)
+    running = []
+    njobs = len(pending)
+    nremaining = njobs
+
+    while len(pending) > 0 or len(running) > 0:
+        nsubmitted = 0
+        while len(pending) > 0 and len(running) < maxjobs:
+            job = pending.pop(0)
+            backend.Submit(job)
+            running.append(job)
+            nsubmitted += 1
+        if nsubmitted > 0:
+            print str(nsubmitted) + " jobs submitted, " + str(len(running)) +\
+                " running, " + str(len(pending)) + " waiting"
+
+        time.sleep(backend.interval)
+        completed = backend.Completed(running)
+        running = [job for job in running if job not in completed]
+
+        if nremaining != len(pending) + len(running):
+            nremaining = len(pending) + len(running)
+            print str(nremaining) + " remaining."
+
+    backend.Finish()
+
+    return True
+
+
+"""
+Reads the last nbytes of every file in files from folder with one shell
+command, run through a Transport, or locally if transport is None. This
+replaces an ls and a full cat of every output per poll with one round trip.
+Returns a dictionary of the tails, files that don't exist yet are left out.
+If the command fails, the error is printed and the dictionary is empty.
+"""
+def OutputTails(files, folder, transport=None, nbytes=1024):
+
+    if len(files) == 0:
+        return {}
+
+    script = 'cd ' + pipes.quote(folder) + ' && for f in ' +\
+        ' '.join([pipes.quote(f) for f in files]) + '; do ' +\
+        'if [ -f "$f" ]; then printf "\\n' + TailMarker + '%s\\n" "$f"; ' +\
+        'tail -c ' + str(nbytes) + ' "$f"; fi; done'
+
+    try:
+        if transport is None:
+            outp = subprocess.check_output(['sh', '-c', script])
+        else:
+            outp = transport.Run(script)
+    except subprocess.CalledProcessError, e:
+        print "Reading the output tails failed: " + str(e.output)
+        return {}
+
+    tails = {}
+    for block in outp.split('\n' + TailMarker)[1:]:
+        f, sep, tail = block.partition('\n')
+        tails[f] = tail
+
+    return tails
+
+
+class LocalQueue:
+    """
+    Stand-in for a cluster queue that runs every job as a local process in
+    folder, for testing the scheduler and backends without a cluster.
+    command is a shell command with {0} in place of the job, eg.
+    'sh {0}' or 'g09 < {0} > {0}.out'. A job has finished when its process
+    has exited.
+    """
+
+    interval = 1
+
+    def __init__(self, command, folder='.'):
+        self.command = command
+        self.folder = folder
+        self.procs = {}
+
+    def Start(self, jobs):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def Submit(self, job):
+        self.procs[job] = subprocess.Popen(self.command.format(job),
+                                           shell=True, cwd=self.folder)
+
+    def Completed(self, jobs):
+
+        completed = []
+        for job in jobs:
+            ret = self.procs[job].poll()
+            if ret is not None:
+                if ret != 0:
+                    print job + " exited with code " + str(ret)
+                completed.append(job)
+
+        return completed
+
+    def Finish(self):
+        pass
+
+
+"""
+Local stand-in for sbatch, used by Transport.LocalTransport. Runs a slurm
+script in the background in the current folder, which becomes
+SLURM_SUBMIT_DIR. For a job array (#SBATCH --array=first-last%throttle)
+every task is run with its SLURM_ARRAY_TASK_ID, at most throttle at a
+time. The output of the tasks goes to slurm-local.log.
+"""
+def LocalSbatch(script):
+
+    log = open('slurm-local.log', 'a')
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), 'tasks',
+                      script], stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+
+    print "Submitted batch job local"
+
+
+#Runs the tasks of a slurm script locally, see LocalSbatch
+def RunLocalTasks(script):
+
+    array = None
+    for line in open(script):
+        m = re.match(r'#SBATCH\s+--array=(\d+)-(\d+)(?:%(\d+))?', line)
+        if m:
+            array = m.groups()
+
+    os.environ['SLURM_SUBMIT_DIR'] = os.getcwd()
+    command = 'sh ' + pipes.quote(os.path.abspath(script))
+    if array is None:
+        queue = LocalQueue(command)
+        RunJobs(['1'], queue, 1)
+    else:
+        first, last, throttle = array
+        tasks = [str(i) for i in range(int(first), int(last) + 1)]
+        if throttle is None:
+            throttle = len(tasks)
+        queue = LocalQueue('SLURM_ARRAY_TASK_ID={0} ' + command)
+        RunJobs(tasks, queue, int(throttle))
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'sbatch':
+        LocalSbatch(sys.argv[2])
+    elif sys.argv[1] == 'tasks':
+        RunLocalTasks(sys.argv[2])
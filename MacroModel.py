@@ -15,10 +15,22 @@ import shutil
 import time
 import re
 
+import numpy
+
+import Conformers
+
+#Seconds between checks of the logs of running conformational searches
+MMPollInterval = 2
+#Bytes read from the end of a log to check for normal termination
+MMLogTail = 4096
+#Seconds a launched search may go without writing its log before it is
+#taken to have failed to start
+MMLogTimeout = 60
+
 
 def SetupMacromodel(numDS, settings, *args):
 
-    for f in args[0]:
+    for f in args:
         
         if settings.Rot5Cycle is True:
             if not os.path.exists(f+'rot.sdf'):
@@ -99,157 +111,335 @@ def SetupMacromodel(numDS, settings, *args):
 
 
 def RunMacromodel(numDS, settings, *args):
-    #Run Macromodel conformation search for all diastereomeric inputs
-    NCompleted = 0
+    #Run Macromodel conformation search for all diastereomeric inputs,
+    #keeping up to settings.MaxConcurrentMMJobs searches running at once
     
     if os.name == 'nt':
         MMPrefix = '"' + settings.SCHRODINGER + '\\bmin" '
     else:
         MMPrefix = settings.SCHRODINGER + "/bmin "
 
-    for ds in args[0]:
-        if not os.path.exists(ds+'.log'):
-            print MMPrefix + ds
-            outp = subprocess.check_output(MMPrefix + ds, shell=True)
+    jobs = []
+    JobDS = {}
+    for ds in args:
+        jobs.append(ds)
+        JobDS[ds] = ds
+        if settings.Rot5Cycle is True:
+            jobs.append(ds + 'rot')
+            JobDS[ds + 'rot'] = ds
+
+    pending = []
+    skipped = []
+    for job in jobs:
+        if not os.path.exists(job + '.log'):
+            pending.append(job)
         else:
-            print ds + ".log exists, skipping"
-            continue
+            print job + ".log exists, skipping"
+            skipped.append(job)
 
-        time.sleep(60)
-        while(not IsMMCompleted(ds + '.log')):
-            time.sleep(30)
-        NCompleted = NCompleted + 1
+    #With settings.StreamPrune the outputs are pruned while they are written
+    Tails = dict([(job, MaeTail(job + '-out.mae')) for job in jobs])
+    Pruners = dict([(ds, None) for ds in args])
 
-        if settings.Rot5Cycle is True:
-            print "Macromodel job " + str(NCompleted) + " of " + str(numDS*2)\
-                + " completed."
-
-            print MMPrefix + ds + 'rot'
-            outp = subprocess.check_output(MMPrefix + ds +'rot', shell=True)
-            time.sleep(60)
-            while(not IsMMCompleted(ds + 'rot.log')):
-                time.sleep(30)
+    NCompleted = 0
+    NJobs = len(pending)
+    running = {}
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < settings.MaxConcurrentMMJobs:
+            job = pending.pop(0)
+            print MMPrefix + job
+            outp = subprocess.check_output(MMPrefix + job, shell=True)
+            running[job] = time.time()
+
+        time.sleep(MMPollInterval)
+        for job in running:
+            if not os.path.exists(job + '.log') and \
+                    time.time() - running[job] > MMLogTimeout:
+                raise IOError("Macromodel job " + job + " wrote no " + job +
+                              ".log within " + str(MMLogTimeout) + " s")
+        completed = [j for j in running if IsMMCompleted(j + '.log')]
+        if settings.StreamPrune and settings.ConfPrune:
+            for job in running:
+                ds = JobDS[job]
+                Pruners[ds] = FeedStreamPruner(
+                    Pruners[ds], Tails[job].Read(job in completed),
+                    settings.InitialRMSDcutoff, settings)
+        for job in completed:
             NCompleted = NCompleted + 1
-            print "Macromodel job " + str(NCompleted) + " of " + str(numDS*2)\
-                + " completed."
-        else:
-            print "Macromodel job " + str(NCompleted) + " of " + str(numDS) +\
-                " completed."
+            walltime = time.time() - running.pop(job)
+            print "Macromodel job " + str(NCompleted) + " of " + str(NJobs) + \
+                " completed (" + job + ", " + format(walltime, ".0f") + " s)."
+
+    #Stream pruned conformers of the structures whose searches were all run
+    return dict([(ds, pruner) for ds, pruner in Pruners.items()
+                 if pruner is not None and
+                 not [j for j in skipped if JobDS[j] == ds]])
 
 
+"""
+Reads the conformers within the energy window from the MacroModel output.
+A first scan of each file only records the energy and the byte offset of
+the atom block of every conformer, the geometries are then read from these
+offsets by the returned LazyEnsemble when they are first needed.
+"""
 def ReadMacromodel(MMoutp, settings):
 
-    conformers = []
-    conformer = -1
     AbsEs = []
+    ConfEs = []
+    Sources = []
 
-    atoms = []
-    charge = 0
-    MaeInps = []
-
-    MaeFile = file(MMoutp + '-out.mae', 'r')
-    MaeInps.append(MaeFile.readlines())
-    MaeFile.close()
+    MaeFiles = [MMoutp + '-out.mae']
 
     if settings.Rot5Cycle is True:
-        MaeFile = file(MMoutp + 'rot-out.mae', 'r')
-        MaeInps.append(MaeFile.readlines())
-        MaeFile.close()
-
-    for MaeInp in MaeInps:
-        index = 0
-        AbsEOffsets = []
-        #find conformer description blocks
-        blocks = []
-        DataIndexes = []
-        for i in range(len(MaeInp)):
-            if 'f_m_ct' in MaeInp[i]:
-                blocks.append(i)
-            if 'p_m_ct' in MaeInp[i]:
-                blocks.append(i)
-
-        #find absolute energy offsets
-        for block in blocks:
-            for i in range(block, len(MaeInp)):
-                if 'mmod_Potential_Energy' in MaeInp[i]:
-                    AbsEOffsets.append(i-block)
-                    break
-
-        #Get absolute energies for conformers
-        for i in range(len(blocks)):
-            for line in range(blocks[i], len(MaeInp)):
-                if ':::' in MaeInp[line]:
-                    AbsEs.append(float(MaeInp[line+AbsEOffsets[i]]))
-                    break
-        
+        MaeFiles.append(MMoutp + 'rot-out.mae')
+
+    for MaeFile in MaeFiles:
+        Index = IndexMae(MaeFile)
+        AbsEs.extend([E for E, offset in Index])
+
         #Pick only the conformers in the energy window
         MinE = min(AbsEs)
-
-        #find geometry descriptions for each block
-        for i in range(len(blocks)):
-            for line in (MaeInp[blocks[i]:]):
-                if 'm_atom' in line:
-                    blocks[i] = blocks[i] + MaeInp[blocks[i]:].index(line)
-                    break
-
-        #find start of atom coordinates for each block
-        for i in range(len(blocks)):
-            if (AbsEs[i] < MinE+settings.MaxCutoffEnergy) or (settings.Cluster == True):
-                #Save the locations of atom number, xyz and charge
-                DataIndex = [0, 0, 0, 0, 0]
-                for offset, line in enumerate(MaeInp[blocks[i]:]):
-                    if 'i_m_mmod_type' in line:
-                        DataIndex[0] = offset-1
-                    if 'r_m_x_coord' in line:
-                        DataIndex[1] = offset-1
-                    if 'r_m_y_coord' in line:
-                        DataIndex[2] = offset-1
-                    if 'r_m_z_coord' in line:
-                        DataIndex[3] = offset-1
-                    if 'r_m_charge1' in line:
-                        DataIndex[4] = offset-1
-                    if ':::' in line:
-                        blocks[i] = blocks[i] + MaeInp[blocks[i]:].index(line)
-                        break
-                DataIndexes.append(DataIndex)
+        for E, offset in Index:
+            if (E < MinE+settings.MaxCutoffEnergy) or (settings.Cluster == True):
+                Sources.append((MaeFile, offset))
+                ConfEs.append(E)
             else:
                 break
 
-        #Read the atom numbers and coordinates
-        for i, block in enumerate(blocks):
-            if (AbsEs[i] < MinE+settings.MaxCutoffEnergy) or (settings.Cluster == True):
-                conformers.append([])
-                conformer = conformer + 1
-                index = block+1
-                atom = 0
-                while not ':::' in MaeInp[index]:
-                    #Replace quoted fields with x
-                    line = (re.sub(r"\".*?\"", "x", MaeInp[index],
-                                        flags=re.DOTALL)).split(' ')
-                    line = [word for word in line[:-1] if word != '']
-                    conformers[conformer].append([])
-                    if conformer == 0:
-                        atoms.append(GetMacromodelSymbol(int(line[DataIndexes[i][0]])))
-                        conformers[0][atom].append(line[0])  # add atom number
-                        conformers[0][atom].append(line[DataIndexes[i][1]])  # add X
-                        conformers[0][atom].append(line[DataIndexes[i][2]])  # add Y
-                        conformers[0][atom].append(line[DataIndexes[i][3]])  # add Z
-                        charge = charge + float(line[DataIndexes[i][4]])
-                        
-                    else:
-                        conformers[conformer][atom].append(line[0])  # add atom number
-                        conformers[conformer][atom].append(line[DataIndexes[i][1]])  # add X
-                        conformers[conformer][atom].append(line[DataIndexes[i][2]])  # add Y
-                        conformers[conformer][atom].append(line[DataIndexes[i][3]])  # add Z
-                        
-                    index = index + 1   # Move to next line
-                    atom = atom + 1     # Move to next atom
-            else:
-                break
+    #Atom types and charge from the first conformer
+    MaeFile, offset = Sources[0]
+    f = open(MaeFile, 'rb')
+    f.seek(offset)
+    types, charges, coords = ReadMaeAtoms(iter(f))
+    f.close()
+    atoms = [GetMacromodelSymbol(t) for t in types]
+    charge = sum(charges)
+
+    def loader(indices):
+        return ReadMaeGeometries(Sources, indices)
+
+    ensemble = Conformers.LazyEnsemble(atoms, loader, range(len(Sources)),
+                                       int(charge), ConfEs,
+                                       Conformers.CoordType(settings))
+
     if settings.Cluster == False:
-        return atoms, conformers, int(charge)
+        return atoms, ensemble, int(charge)
     else:
-        return atoms, conformers, int(charge), AbsEs
+        return atoms, ensemble, int(charge), AbsEs
+
+
+#Line iterator over an MAE file that keeps the byte offset of the next line
+class MaeLines:
+
+    def __init__(self, f):
+        self.lines = iter(f)
+        self.pos = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = next(self.lines)
+        self.pos += len(line)
+        return line
+
+
+"""
+Walks the conformer blocks (f_m_ct or p_m_ct) of an MAE file and yields the
+energy of each conformer and the byte offset of its atom block header, with
+lines positioned at that header. The atom block can then be read with
+ReadMaeAtoms, or left to be skipped on the way to the next block.
+"""
+def MaeBlocks(lines):
+
+    for line in lines:
+        if not ('f_m_ct' in line or 'p_m_ct' in line):
+            continue
+
+        #Block keys, the energy is on the matching line after :::
+        EOffset = 0
+        offset = 0
+        for line in lines:
+            if ':::' in line:
+                break
+            offset += 1
+            if EOffset == 0 and 'mmod_Potential_Energy' in line:
+                EOffset = offset
+        for offset in range(EOffset):
+            line = next(lines)
+        E = float(line)
+
+        for line in lines:
+            if 'm_atom' in line:
+                break
+
+        yield E, lines.pos
+
+
+#Reads an atom block from its header, the atom columns are looked up once
+#in the header. Returns the atom types, the charges and the coordinates as
+#a (natoms, 3) float array
+def ReadMaeAtoms(lines):
+
+    Columns = ['i_m_mmod_type', 'r_m_x_coord', 'r_m_y_coord', 'r_m_z_coord',
+               'r_m_charge1']
+
+    #The first column is the atom index
+    Header = []
+    for line in lines:
+        if ':::' in line:
+            break
+        Header.append(line.strip())
+    Index = [Header.index(c) if c in Header else -1 for c in Columns]
+
+    types = []
+    charges = []
+    coords = []
+    for line in lines:
+        if ':::' in line:
+            break
+        #Replace quoted fields with x
+        if '"' in line:
+            line = re.sub(r"\".*?\"", "x", line, flags=re.DOTALL)
+        data = line.split()
+        types.append(int(data[Index[0]]))
+        coords.append([float(data[Index[1]]), float(data[Index[2]]),
+                       float(data[Index[3]])])
+        if Index[4] >= 0:
+            charges.append(float(data[Index[4]]))
+
+    return types, charges, numpy.array(coords)
+
+
+#Energies and atom block offsets of all conformers in an MAE file
+def IndexMae(MaeFile):
+
+    f = open(MaeFile, 'rb')
+    Index = list(MaeBlocks(MaeLines(f)))
+    f.close()
+
+    return Index
+
+
+#Coordinates of the conformers at Sources[i], a (file, offset) pair, for
+#all i in indices, every file is opened only once
+def ReadMaeGeometries(Sources, indices):
+
+    files = {}
+    coords = []
+    for i in indices:
+        MaeFile, offset = Sources[i]
+        if MaeFile not in files:
+            files[MaeFile] = open(MaeFile, 'rb')
+        files[MaeFile].seek(offset)
+        coords.append(ReadMaeAtoms(iter(files[MaeFile]))[2])
+    for f in files.values():
+        f.close()
+
+    return numpy.array(coords)
+
+
+"""
+Single pass reader of the conformers in a MacroModel -out.mae file. Yields
+(energy, atom types, atom charges, coordinates) for every conformer block
+as soon as its atom block has been read, with the coordinates as a
+(natoms, 3) float array.
+
+With an energy window, only conformers within window of the lowest energy
+seen so far (starting from MinE) have their atoms decoded, for the others
+types, charges and coordinates are None.
+"""
+def MaeConformers(MaeFile, window=None, MinE=float('inf')):
+
+    f = open(MaeFile, 'rb')
+    lines = MaeLines(f)
+    try:
+        for E, offset in MaeBlocks(lines):
+            MinE = min(MinE, E)
+            if (window is None) or (E < MinE + window):
+                types, charges, coords = ReadMaeAtoms(lines)
+                yield E, types, charges, coords
+            else:
+                yield E, None, None, None
+    finally:
+        f.close()
+
+
+#Start of a conformer block, the blocks of an MAE file are not indented
+MaeBlockStart = re.compile(r'^[fp]_m_ct \{', re.M)
+
+
+class MaeTail:
+    """
+    Follows an -out.mae file while bmin is still writing it. Every call of
+    Read returns the conformers of the blocks completed since the last call,
+    as (energy, atom types, atom charges, coordinates). A block is complete
+    once the next block has started, or once the search has finished and
+    Read is called with final set.
+    """
+
+    def __init__(self, MaeFile):
+        self.MaeFile = MaeFile
+        self.pos = 0
+
+    def Read(self, final=False):
+
+        if not os.path.exists(self.MaeFile):
+            return []
+
+        f = open(self.MaeFile, 'rb')
+        f.seek(self.pos)
+        data = f.read()
+        f.close()
+
+        starts = [m.start() for m in MaeBlockStart.finditer(data)]
+        ends = starts[1:]
+        if final and len(starts) > 0:
+            ends.append(len(data))
+
+        confs = []
+        for start, end in zip(starts, ends):
+            lines = MaeLines(iter(data[start:end].splitlines(True)))
+            for E, offset in MaeBlocks(lines):
+                types, charges, coords = ReadMaeAtoms(lines)
+                confs.append((E, types, charges, coords))
+        if len(ends) > 0:
+            self.pos += ends[-1]
+
+        return confs
+
+
+#Adds MAE conformers to a ConfPrune.StreamPruner, which is made from the
+#first conformer if pruner is None, conformers without coordinates (outside
+#the MaeConformers window) are passed over. Returns the pruner
+def FeedStreamPruner(pruner, confs, cutoff, settings):
+
+    for E, types, charges, coords in confs:
+        if coords is None:
+            continue
+        if pruner is None:
+            import pyximport
+            pyximport.install()
+            import ConfPrune
+            atoms = [GetMacromodelSymbol(t) for t in types]
+            pruner = ConfPrune.StreamPruner(atoms, cutoff,
+                                            settings.MaxCutoffEnergy, settings,
+                                            int(sum(charges)))
+        pruner.Add(E, coords)
+
+    return pruner
+
+
+#Stream pruning of finished MacroModel output, the conformers are pruned
+#as they are parsed and the ensemble is never held in memory as a whole
+def StreamPruneMae(MMoutp, cutoff, settings):
+
+    pruner = None
+    for MaeFile in Conformers.MMOutputFiles(MMoutp, settings):
+        confs = MaeConformers(MaeFile, settings.MaxCutoffEnergy)
+        pruner = FeedStreamPruner(pruner, confs, cutoff, settings)
+
+    return pruner
 
 
 def GetMacromodelSymbol(atomType):
@@ -277,9 +467,16 @@ def getScriptPath():
     return os.path.dirname(os.path.realpath(sys.argv[0]))
 
 
+#Bmin writes its log as it goes, only the end of the log is read
 def IsMMCompleted(f):
-    Gfile = open(f, 'r')
-    outp = Gfile.readlines()
+
+    if not os.path.exists(f):
+        return False
+
+    Gfile = open(f, 'rb')
+    Gfile.seek(0, 2)
+    Gfile.seek(max(0, Gfile.tell() - MMLogTail))
+    outp = Gfile.read().splitlines()
     Gfile.close()
 
     if os.name == 'nt':
@@ -287,7 +484,7 @@ def IsMMCompleted(f):
     else:
         i = -3
 
-    if "normal termination" in outp[i]:
+    if len(outp) >= -i and "normal termination" in outp[i]:
         return True
     else:
         return False
@@ -8,15 +8,18 @@ Contains all of the NWChem specific code for input generation and calculation
 execution. Called by PyDP4.py.
 """
 
-import Tinker
-import MacroModel
+import Conformers
+import JobScheduler
+import Transport
 import nmrPredictNWChem
 
 import glob
 import os
 import subprocess
-import time
-import socket
+
+#Bytes read from the end of an output to check for normal termination
+NWChemTail = 8192
+
 """
 if os.name == 'nt':
     import pyximport
@@ -33,17 +36,15 @@ def SetupNWChem(MMoutp, NWCheminp, numDigits, settings, adjRMSDcutoff):
     #Reads conformer geometry, energies and atom labels from Tinker output
     #(atoms, conformers) = ReadConformers(MMoutp, MaxEnergy)
 
-    if settings.MMTinker:
-        #Reads conformer geometry, energies and atom labels from Tinker output
-        (atoms, conformers, charge) = Tinker.ReadTinker(MMoutp, settings)
-    else:
-        (atoms, conformers, charge) = MacroModel.ReadMacromodel(MMoutp,
-                                                                settings)
+    #Reads conformer geometry, energies and atom labels from the MM output
+    (atoms, conformers, charge) = Conformers.ReadConformers(MMoutp, settings)
     if settings.charge is not None:
         charge = settings.charge
     #Prune similar conformations, if the number exceeds the limit
     if len(conformers) > settings.PerStructConfLimit:
-        pruned = ConfPrune.RMSDPrune(conformers, atoms, adjRMSDcutoff)
+        pruned = ConfPrune.RMSDPrune(conformers, atoms, adjRMSDcutoff,
+                                     Conformers.RMSDCacheFile(MMoutp, settings),
+                                     settings)
     else:
         pruned = conformers
 
@@ -62,16 +63,14 @@ def SetupNWChem(MMoutp, NWCheminp, numDigits, settings, adjRMSDcutoff):
 #Adjust the RMSD cutoff to keep the conformation numbers reasonable
 def AdaptiveRMSD(MMoutp, settings):
 
-    if settings.MMTinker:
-        #Reads conformer geometry, energies and atom labels from Tinker output
-        (atoms, conformers, charge) = Tinker.ReadTinker(MMoutp, settings)
-    else:
-        (atoms, conformers, charge) = MacroModel.ReadMacromodel(MMoutp,
-                                                                settings)
+    #Reads conformer geometry, energies and atom labels from the MM output
+    (atoms, conformers, charge) = Conformers.ReadConformers(MMoutp, settings)
 
     return ConfPrune.AdaptRMSDPrune(conformers, atoms,
                                     settings.InitialRMSDcutoff,
-                                    settings.PerStructConfLimit)
+                                    settings.PerStructConfLimit,
+                                    Conformers.RMSDCacheFile(MMoutp, settings),
+                                    settings)
 
 
 def WriteNWChemFile(NWCheminp, conformer, atoms, charge, settings):
@@ -213,107 +212,111 @@ def IsNWChemCompleted(f):
         return False
 
 
+#Runs the NWChem jobs on ziggy, settings.MaxConcurrentJobs at a time
 def RunOnZiggy(folder, queue, NWFiles, settings):
 
     print "ziggy NWChem job submission script\n"
 
-    #Check that folder does not exist, create job folder on ziggy
-    outp = subprocess.check_output('ssh ziggy ls', shell=True)
-    if folder in outp:
-        print "Folder exists on ziggy, choose another folder name."
-        return
+    backend = ZiggyQueue(queue, folder, settings)
+    JobScheduler.RunJobs(NWFiles, backend, settings.MaxConcurrentJobs)
+
+
+#NWChem jobs on the ziggy PBS queue, one qsub script per job
+class ZiggyQueue:
+
+    interval = 60
 
-    outp = subprocess.check_output('ssh ziggy mkdir ' + folder, shell=True)
-    #Write the qsub scripts
-    for f in NWFiles:
-        WriteSubScript(f[:-3], queue, folder, settings)
-    print str(len(NWFiles)) + ' .qsub scripts generated'
-
-    #Upload .com files and .qsub files to directory
-    print "Uploading files to ziggy..."
-    for f in NWFiles:
-        outp = subprocess.check_output('scp ' + f +' ziggy:~/' + folder,
-                                       shell=True)
-        outp = subprocess.check_output('scp ' + f[:-3] +'.qsub ziggy:~/' +
-                                       folder, shell=True)
-
-    print str(len(NWFiles)) + ' .nw and .qsub files uploaded to ziggy'
-
-    #Launch the calculations
-    for f in NWFiles:
-        job = '~/' + folder + '/' + f[:-3]
-        outp = subprocess.check_output('ssh ziggy qsub -q ' + queue + ' -o '
-            + job + '.log -e ' + job + '.err -l nodes=1:ppn=1:ivybridge ' +
-            job + '.qsub', shell=True)
-        time.sleep(3)
-
-    print str(len(NWFiles)) + ' jobs submitted to the queue on ziggy'
-
-    outp = subprocess.check_output('ssh ziggy showq', shell=True)
-    if settings.user in outp:
-        print "Jobs are running on ziggy"
-
-    Jobs2Complete = list(NWFiles)
-    n2complete = len(Jobs2Complete)
-
-    #Check and report on the progress of calculations
-    while len(Jobs2Complete) > 0:
-        JustCompleted = [job for job in Jobs2Complete if
-            IsZiggyGComplete(job[:-2] + 'nwo', folder, settings)]
-        Jobs2Complete[:] = [job for job in Jobs2Complete if
-             not IsZiggyGComplete(job[:-2] + 'nwo', folder, settings)]
-        if n2complete != len(Jobs2Complete):
-            n2complete = len(Jobs2Complete)
-            print str(n2complete) + " remaining."
-
-        time.sleep(60)
-
-    #When done, copy the results back
-    print "\nCopying the output files back to localhost..."
-    print 'ssh ziggy scp /home/' + settings.user + '/' + folder + '/*.nwo ' +\
-        socket.getfqdn() + ':' + os.getcwd()
-    outp = subprocess.check_output('ssh ziggy scp /home/' + settings.user + '/'
-                                   + folder + '/*.nwo ' + socket.getfqdn() + ':'
-                                   + os.getcwd(), shell=True)
+    def __init__(self, queue, folder, settings):
+        self.queue = queue
+        self.folder = folder
+        self.settings = settings
+        self.ziggy = Transport.GetTransport('ziggy', settings)
 
+    def Start(self, jobs):
 
+        #Check that folder does not exist, create job folder on ziggy
+        outp = self.ziggy.Run('ls')
+        if self.folder in outp.split():
+            print "Folder exists on ziggy, choose another folder name."
+            return False
+
+        outp = self.ziggy.Run('mkdir ' + self.folder)
+
+        #With settings.BulkTransfer all inputs go up in one archive
+        if self.settings.BulkTransfer:
+            files = []
+            for f in jobs:
+                WriteSubScript(f[:-3], self.queue, self.folder, self.settings)
+                files.extend([f, f[:-3] + '.qsub'])
+            self.ziggy.PutArchive(files, self.folder,
+                                  self.settings.BulkCompress)
+            print str(len(jobs)) + ' .nw and .qsub files uploaded to ziggy'
+
+    def Submit(self, f):
+
+        #Write the qsub script and upload it with the .nw file
+        if not self.settings.BulkTransfer:
+            WriteSubScript(f[:-3], self.queue, self.folder, self.settings)
+            self.ziggy.Put([f, f[:-3] + '.qsub'], '~/' + self.folder)
+
+        #Launch the calculation
+        job = '~/' + self.folder + '/' + f[:-3]
+        outp = self.ziggy.Run('qsub -q ' + self.queue + ' -o ' + job +
+                              '.log -e ' + job + '.err -l ' +
+                              'nodes=1:ppn=1:ivybridge ' + job + '.qsub')
+
+    def Completed(self, jobs):
+        JobFinished = IsZiggyGComplete([job[:-2] + 'nwo' for job in jobs],
+                                       self.folder, self.settings)
+        return [job for job in jobs if JobFinished[job[:-2] + 'nwo']]
+
+    def Finish(self):
+
+        #When done, copy the results back
+        print "\nCopying the output files back to localhost..."
+        if self.settings.BulkTransfer:
+            self.ziggy.GetArchive(['*.nwo'], self.folder, os.getcwd(),
+                                  self.settings.BulkCompress)
+        else:
+            self.ziggy.Get(['~/' + self.folder + '/*.nwo'], os.getcwd())
+
+
+#Runs the NWChem jobs on the local Medivir PBS queue,
+#settings.MaxConcurrentJobs at a time
 def RunOnMedivir(NWFiles, settings):
 
     print "Medivir NWChem job submission script\n"
 
-    #Write the qsub scripts
-    for f in NWFiles:
-        WriteMedivirSubScript(f[:-3], settings)
-    print str(len(NWFiles)) + ' .qsub scripts generated'
+    JobScheduler.RunJobs(NWFiles, MedivirQueue(settings),
+                         settings.MaxConcurrentJobs)
 
-    #Launch the calculations
-    for f in NWFiles:
-        job = f[:-3]
-        outp = subprocess.check_output('qsub ' + job + '.qsub', shell=True)
-        time.sleep(3)
+    print "Calculation on the cluster done.\n"
 
-    print str(len(NWFiles)) + ' jobs submitted to the queue on ziggy'
 
-    outp = subprocess.check_output('qstat', shell=True)
-    if 'nwinp' in outp:
-        print "Jobs are running on the cluster"
+#NWChem jobs on the Medivir PBS queue, submitted from the working directory
+class MedivirQueue:
 
-    Jobs2Complete = list(NWFiles)
-    n2complete = len(Jobs2Complete)
+    interval = 60
 
-    #Check and report on the progress of calculations
-    while len(Jobs2Complete) > 0:
-        JustCompleted = [job for job in Jobs2Complete if
-            IsMedivirComplete(job[:-2] + 'nwo', settings)]
-        Jobs2Complete[:] = [job for job in Jobs2Complete if
-             not IsMedivirComplete(job[:-2] + 'nwo', settings)]
-        if n2complete != len(Jobs2Complete):
-            n2complete = len(Jobs2Complete)
-            print str(n2complete) + " remaining."
+    def __init__(self, settings):
+        self.settings = settings
 
-        time.sleep(60)
+    def Start(self, jobs):
+        pass
 
-    print "Calculation on the cluster done.\n"
+    def Submit(self, f):
+
+        job = f[:-3]
+        WriteMedivirSubScript(job, self.settings)
+        outp = subprocess.check_output('qsub ' + job + '.qsub', shell=True)
+
+    def Completed(self, jobs):
+        JobFinished = IsMedivirComplete([job[:-2] + 'nwo' for job in jobs],
+                                        self.settings)
+        return [job for job in jobs if JobFinished[job[:-2] + 'nwo']]
+
+    def Finish(self):
+        pass
                                    
                                    
 def WriteSubScript(NWJob, queue, ZiggyJobFolder, settings):
@@ -394,39 +397,29 @@ def WriteMedivirSubScript(NWJob, settings):
     QSub.close()
     
 
-def IsZiggyGComplete(f, folder, settings):
+#Checks which of the NWChem outputs on ziggy have finished, with one
+#remote command for all of them. The author list printed at the end of a
+#run fits in the last NWChemTail bytes
+def IsZiggyGComplete(outfiles, folder, settings):
 
-    path = '/home/' + settings.user + '/' + folder + '/'
-    try:
-        outp1 = subprocess.check_output('ssh ziggy ls ' + path, shell=True)
-    except subprocess.CalledProcessError, e:
-        print "ssh ziggy ls failed: " + str(e.output)
-        return False
-    if f in outp1:
-        try:
-            outp2 = subprocess.check_output('ssh ziggy cat ' + path + f,
-                                            shell=True)
-        except subprocess.CalledProcessError, e:
-            print "ssh ziggy cat failed: " + str(e.output)
-            return False
-        if "AUTHORS" in outp2:
-            return True
-    return False
+    tails = JobScheduler.OutputTails(outfiles, folder,
+                                     Transport.GetTransport('ziggy', settings),
+                                     NWChemTail)
 
+    results = {}
+    for f in outfiles:
+        results[f] = "AUTHORS" in tails.get(f, '')
 
-def IsMedivirComplete(f, settings):
+    return results
 
-    try:
-        outp1 = subprocess.check_output('ls ', shell=True)
-    except subprocess.CalledProcessError, e:
-        print "ls failed: " + str(e.output)
-        return False
-    if f in outp1:
-        try:
-            outp2 = subprocess.check_output('cat ' + f, shell=True)
-        except subprocess.CalledProcessError, e:
-            print "cat failed: " + str(e.output)
-            return False
-        if "AUTHORS" in outp2:
-            return True
-    return False
+
+#Checks which of the NWChem outputs in the working directory have finished
+def IsMedivirComplete(outfiles, settings):
+
+    tails = JobScheduler.OutputTails(outfiles, os.getcwd(), None, NWChemTail)
+
+    results = {}
+    for f in outfiles:
+        results[f] = "AUTHORS" in tails.get(f, '')
+
+    return results
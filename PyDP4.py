@@ -90,17 +90,38 @@ class Settings:
     RenumberFile = ''
     ScriptDir = ''
     user = 'ke291'
+    LocalRemoteDir = ''  # Run cluster commands in this local folder instead
+    BulkTransfer = False  # Move cluster inputs and outputs as one tar stream
+    BulkCompress = True  # Compress the bulk transfer tar streams
+    JobArray = False  # Submit the ziggy Gaussian jobs as one slurm job array
+    ArrayThrottle = 0  # Max running array tasks, 0 uses MaxConcurrentJobs
     OnlyConfS = False # Stop the process after conformational search
     MMstepcount = 10000
     MMfactor = 2500  # nsteps = MMfactor*degrees of freedom
     HardConfLimit = 10000
     MaxConcurrentJobs = 75
     MaxConcurrentJobsDarwin = 320
+    MaxConcurrentMMJobs = 1  # Conformational searches run at the same time
     PerStructConfLimit = 100
     StrictConfLimit = True
     Cluster = False
+    ClusterMethod = 'hdbscan'  # 'hdbscan', energy 'leader' or 'kmedoids'
+    ClusterMinSize = 4  # Smallest HDBSCAN cluster
+    ClusterRadius = 0.5  # Leader radius in (sin, cos) torsion space
+    ClusterCount = 0  # k-medoids clusters, 0 uses PerStructConfLimit
     InitialRMSDcutoff = 0.75
+    PruneMode = 'greedy'  # 'greedy' on the full RMSD matrix or energy 'leader'
+    PruneProc = 1  # Processes used to compute the RMSD matrix
+    RMSDEncoding = 'float64'  # RMSD matrix storage: float64, float32 or uint16
+    RMSDMemoryLimit = 2000  # MB, larger RMSD matrices are kept on disk
+    RMSDPrefilter = True  # Skip aligning pairs whose RMSD bound is above cutoff
+    RMSDAtoms = 'all'  # Atoms aligned in pruning: 'all', 'heavy' or 'polarH'
+    RMSDMassWeight = False  # Weight the aligned atoms by their mass
+    StreamPrune = False  # Leader prune MacroModel conformers as they are read
     MaxCutoffEnergy = 10.0
+    SinglePrecisionCoords = False  # Store MM conformer coordinates as float32
+    PopulationTarget = 1.0  # MM Boltzmann population kept, 1.0 keeps all
+    PopulationConfLimit = 0  # Max conformers kept by population, 0 no limit
     TMS_SC_C13 = 191.69255
     TMS_SC_H1 = 31.7518583
     CFCl3_SC_F19 = 180.9961
@@ -217,6 +238,9 @@ def main(filename, ExpNMR, nfiles):
                 MMRun = False
                 mminpfiles.append(f)
 
+    #Conformers pruned while the MacroModel searches ran, with StreamPrune
+    StreamPruned = {}
+
     if MMRun or settings.AssumeDone or settings.UseExistingInputs:
         print 'Conformation search has already been run for these inputs.\
                 \nSkipping...'
@@ -241,14 +265,19 @@ def main(filename, ExpNMR, nfiles):
                 print "Input files generated, quitting..."
                 quit()
             print '\nRunning Macromodel...'
-            MacroModel.RunMacromodel(len(inpfiles), settings, *mminpfiles)
+            StreamPruned = MacroModel.RunMacromodel(len(inpfiles), settings,
+                                                    *mminpfiles)
 
     if settings.OnlyConfS:
         print "Conformational search completed, quitting as instructed."
         quit()
 
     if (not settings.AssumeDone) and (not settings.UseExistingInputs):
-        if settings.ConfPrune and not settings.Cluster:
+        #Stream pruning of MacroModel output for Gaussian uses the initial
+        #cutoff, as the adaptive cutoff needs the whole ensemble
+        StreamPrune = settings.StreamPrune and not settings.MMTinker and \
+            (settings.DFT == 'z' or settings.DFT == 'g' or settings.DFT == 'd')
+        if settings.ConfPrune and not settings.Cluster and not StreamPrune:
             if settings.DFT == 'z' or settings.DFT == 'g' or settings.DFT == 'd':
                 adjRMSDcutoff = Gaussian.AdaptiveRMSD(inpfiles[0], settings)
             elif settings.DFT == 'n' or settings.DFT == 'w' or settings.DFT == 'm':
@@ -269,7 +298,7 @@ def main(filename, ExpNMR, nfiles):
                     " of " +  str(len(inpfiles)) + ")"
                 if settings.Cluster == False:
                     Gaussian.SetupGaussian(ds, ds + 'ginp', 3, settings,
-                                           adjRMSDcutoff)
+                                           adjRMSDcutoff, StreamPruned.get(ds))
                 else:
                     Gaussian.SetupGaussianCluster(ds, ds + 'ginp', 3, settings)
             elif settings.DFT == 'n' or settings.DFT == 'w' or settings.DFT == 'm':
@@ -336,48 +365,22 @@ def main(filename, ExpNMR, nfiles):
             print '\nRunning Gaussian on Ziggy...'
 
             #Run Gaussian jobs on Ziggy cluster in folder named after date
-            #and time in the short 1processor job queue
-            #and wait until the last file is completed
-            MaxCon = settings.MaxConcurrentJobs
+            #and time in the short 1processor job queue, keeping
+            #MaxConcurrentJobs in the queue until the last file is completed
             if settings.DFTOpt or settings.PM6Opt or settings.HFOpt or settings.M06Opt:
                 for i in range(len(Files2Run)):
                     Files2Run[i] = Files2Run[i][:-5] + '.com'
-            if len(Files2Run) < MaxCon:
-                Gaussian.RunOnZiggy(0, settings.queue, Files2Run, settings)
-            else:
-                print "The DFT calculations will be done in " +\
-                    str(math.ceil(len(Files2Run)/MaxCon)) + " batches"
-                i = 0
-                while (i+1)*MaxCon < len(Files2Run):
-                    print "Starting batch nr " + str(i+1)
-                    Gaussian.RunOnZiggy(str(i+1), settings.queue, Files2Run[(i*MaxCon):((i+1)*MaxCon)], settings)
-                    i += 1
-                print "Starting batch nr " + str(i+1)
-                Gaussian.RunOnZiggy(str(i+1), settings.queue, Files2Run[(i*MaxCon):], settings)
+            Gaussian.RunOnZiggy(settings.queue, Files2Run, settings)
+
         elif settings.DFT == 'd':
             print '\nRunning Gaussian on Darwin...'
 
             #Run Gaussian jobs on Darwin cluster in folder named after date
             #and title and wait until the last file is completed
-            MaxCon = settings.MaxConcurrentJobsDarwin
-            
             if settings.DFTOpt or settings.PM6Opt or settings.HFOpt or settings.M06Opt:
                 for i in range(len(Files2Run)):
                     Files2Run[i] = Files2Run[i][:-5] + '.com'
-                    
-            if len(Files2Run) < MaxCon:
-                Gaussian.RunOnDarwin(0, Files2Run, settings)
-            else:
-                print "The DFT calculations will be done in " +\
-                    str(math.ceil(len(Files2Run)/MaxCon)) + " batches"
-                i = 0
-                while (i+1)*MaxCon < len(Files2Run):
-                    print "Starting batch nr " + str(i+1)
-                    Gaussian.RunOnDarwin(str(i+1), Files2Run[(i*MaxCon):((i+1)*MaxCon)],
-                        settings)
-                    i += 1
-                print "Starting batch nr " + str(i+1)
-                Gaussian.RunOnDarwin(str(i+1), Files2Run[(i*MaxCon):], settings)
+            Gaussian.RunOnDarwin(Files2Run, settings)
 
         elif settings.DFT == 'n':
             print '\nRunning NWChem locally...'
@@ -390,41 +393,15 @@ def main(filename, ExpNMR, nfiles):
             #and time in the short 1 processor job queue
             #and wait until the last file is completed
             now = datetime.datetime.now()
-            MaxCon = settings.MaxConcurrentJobs
-            if len(Files2Run) < MaxCon:
-                NWChem.RunOnZiggy(now.strftime('%d%b%H%M'), settings.queue,
-                                  Files2Run, settings)
-            else:
-                print "The DFT calculations will be done in " +\
-                    str(math.ceil(len(Files2Run)/MaxCon)) + " batches"
-                i = 0
-                while (i+1)*MaxCon < len(Files2Run):
-                    print "Starting batch nr " + str(i+1)
-                    NWChem.RunOnZiggy(now.strftime('%d%b%H%M')+str(i+1),
-                        settings.queue, Files2Run[(i*MaxCon):((i+1)*MaxCon)], settings)
-                    i += 1
-                print "Starting batch nr " + str(i+1)
-                NWChem.RunOnZiggy(now.strftime('%d%b%H%M')+str(i+1),
-                    settings.queue, Files2Run[(i*MaxCon):], settings)
-        
+            NWChem.RunOnZiggy(now.strftime('%d%b%H%M'), settings.queue,
+                              Files2Run, settings)
+
         elif settings.DFT == 'm':
             print '\nRunning NWChem on Medivir cluster...'
 
             #Run NWChem jobs on Medivir cluster
-            MaxCon = settings.MaxConcurrentJobs
-            if len(Files2Run) < MaxCon:
-                NWChem.RunOnMedivir(Files2Run, settings)
-            else:
-                print "The DFT calculations will be done in " +\
-                    str(math.ceil(len(Files2Run)/MaxCon)) + " batches"
-                i = 0
-                while (i+1)*MaxCon < len(Files2Run):
-                    print "Starting batch nr " + str(i+1)
-                    NWChem.RunOnMedivir(Files2Run[(i*MaxCon):((i+1)*MaxCon)], settings)
-                    i += 1
-                print "Starting batch nr " + str(i+1)
-                NWChem.RunOnMedivir(Files2Run[(i*MaxCon):], settings)
-        
+            NWChem.RunOnMedivir(Files2Run, settings)
+
         elif settings.DFT == 'j':
             print '\nRunning Jaguar locally...'
             Jaguar.RunJaguar(Files2Run, settings)
@@ -513,18 +490,82 @@ if __name__ == '__main__':
     of structure files", type=int, default=1)
     parser.add_argument("--nProc", help="Specify number of processor cores\
     to use for Gaussian calculations", type=int, default=1)
-    parser.add_argument("--batch", help="Specify max number of jobs per batch",
+    parser.add_argument("--LocalRemote", help="Run the cluster commands and \
+    transfers in subfolders of this local folder instead of over ssh, for \
+    testing", default=settings.LocalRemoteDir)
+    parser.add_argument("--BulkTransfer", help="Upload all cluster inputs \
+    and download all outputs as one tar stream each", action="store_true")
+    parser.add_argument("--NoBulkCompress", help="Don't compress the bulk \
+    transfer tar streams", action="store_true")
+    parser.add_argument("--JobArray", help="Submit the Gaussian jobs on \
+    ziggy as one slurm job array", action="store_true")
+    parser.add_argument("--ArrayThrottle", help="Specify max number of job \
+    array tasks running at once, 0 to use the --batch value", type=int,
+    default=settings.ArrayThrottle)
+    parser.add_argument("--batch", help="Specify max number of jobs in the queue at once",
     type=int, default=75)
+    parser.add_argument("--MMJobs", help="Specify max number of conformational \
+    searches run at the same time", type=int,
+    default=settings.MaxConcurrentMMJobs)
     parser.add_argument("-l", "--ConfLimit", help="Specify maximum number of \
     conformers per structure. If above this, adaptive RMSD pruning will be \
     performed", type=int, default=100)
     parser.add_argument("--MaxConfE", help="Specify maximum MMFF energy \
     allowed before conformer is discarded before DFT stage", type=float,\
     default=settings.MaxCutoffEnergy)
+    parser.add_argument("--PruneMode", help="Select RMSD pruning mode, \
+    greedy prunes on the full RMSD matrix, leader compares conformers in \
+    order of MM energy only against the kept ones, default is greedy",
+    choices=['greedy', 'leader'], default=settings.PruneMode)
+    parser.add_argument("--PruneProc", help="Specify number of processes \
+    to use for the RMSD matrix calculation during conformer pruning",
+    type=int, default=settings.PruneProc)
+    parser.add_argument("--RMSDPrecision", help="Select storage of the RMSD \
+    matrix used for pruning, float64, float32 or uint16 (0.001 angstrom fixed \
+    point), default is float64", choices=['float64', 'float32', 'uint16'],
+    default=settings.RMSDEncoding)
+    parser.add_argument("--RMSDMemory", help="Specify memory limit in MB for \
+    the RMSD matrix, larger matrices are stored on disk", type=int,
+    default=settings.RMSDMemoryLimit)
+    parser.add_argument("--NoPrefilter", help="Align every conformer pair \
+    during pruning instead of skipping pairs whose rotation invariant RMSD \
+    lower bound is already above the cutoff", action="store_true")
+    parser.add_argument("--RMSDAtoms", help="Select the atoms aligned during \
+    conformer pruning, all, heavy for heavy atoms only or polarH for heavy \
+    atoms and hydrogens on N, O and S, default is all",
+    choices=['all', 'heavy', 'polarH'], default=settings.RMSDAtoms)
+    parser.add_argument("--MassWeight", help="Weight the atoms by their mass \
+    when aligning conformers during pruning", action="store_true")
+    parser.add_argument("--MMPopulation", help="Keep only the lowest MM \
+    energy conformers that make up this fraction of the MM Boltzmann \
+    population, eg. 0.99, default keeps all", type=float,
+    default=settings.PopulationTarget)
+    parser.add_argument("--MMPopLimit", help="Specify max number of \
+    conformers kept by the MM Boltzmann population screen, 0 for no limit",
+    type=int, default=settings.PopulationConfLimit)
+    parser.add_argument("--StreamPrune", help="Leader prune the MacroModel \
+    conformers with the initial RMSD cutoff while the search writes them, \
+    Gaussian only, not with --MMPopulation or --MMPopLimit",
+    action="store_true")
+    parser.add_argument("--SinglePrecision", help="Store the MM conformer \
+    coordinates in single precision to halve their memory use",
+    action="store_true")
     parser.add_argument("--StrictConfLimit", help="Strictly enforce per struct \
     conf limit at the cost of abandoning consistent RMSD cutoff value", action="store_true")
-    parser.add_argument("--Cluster", help="Use HDBSCAN clustering algorithm to decide which" \
-                        + " conformers to calculate", action="store_true")
+    parser.add_argument("--Cluster", help="Cluster the conformers on their" \
+                        + " torsions and calculate the lowest energy" \
+                        + " conformer of each cluster", action="store_true")
+    parser.add_argument("--ClusterMethod", help="Clustering algorithm used \
+    with --Cluster", choices=['hdbscan', 'leader', 'kmedoids'],
+    default=settings.ClusterMethod)
+    parser.add_argument("--ClusterMinSize", help="Specify the smallest \
+    HDBSCAN cluster", type=int, default=settings.ClusterMinSize)
+    parser.add_argument("--ClusterRadius", help="Specify the leader \
+    clustering radius in sin/cos torsion space", type=float,
+    default=settings.ClusterRadius)
+    parser.add_argument("--ClusterCount", help="Specify the number of \
+    k-medoids clusters, 0 to use the per structure conformer limit", type=int,
+    default=settings.ClusterCount)
     parser.add_argument("-r", "--rot5", help="Manually generate conformers for\
     5-memebered rings", action="store_true")
     parser.add_argument("--jJ", help="Calculate coupling constants at DFT\
@@ -602,16 +643,34 @@ if __name__ == '__main__':
     settings.ForceField = args.ff
     settings.PerStructConfLimit = args.ConfLimit
     settings.MaxCutoffEnergy = args.MaxConfE
+    settings.PruneMode = args.PruneMode
+    settings.PruneProc = args.PruneProc
+    settings.RMSDEncoding = args.RMSDPrecision
+    settings.RMSDMemoryLimit = args.RMSDMemory
+    settings.RMSDAtoms = args.RMSDAtoms
+    settings.PopulationTarget = args.MMPopulation
+    settings.PopulationConfLimit = args.MMPopLimit
+    settings.ClusterMethod = args.ClusterMethod
+    settings.ClusterMinSize = args.ClusterMinSize
+    settings.ClusterRadius = args.ClusterRadius
+    settings.ClusterCount = args.ClusterCount
     settings.BasisSet = args.BasisSet
     settings.Functional = args.Functional
     settings.nProc = args.nProc
     settings.MaxConcurrentJobs = args.batch
+    settings.LocalRemoteDir = args.LocalRemote
+    settings.ArrayThrottle = args.ArrayThrottle
+    settings.MaxConcurrentMMJobs = args.MMJobs
     settings.MaxDFTOptCycles = args.OptCycles
     
     if settings.DFT == 'd' and not args.TimeLimit:
         print "For calculations on Darwin explicit time limit in hours " + \
             "must be specified, exiting..."
         quit()
+    if args.StreamPrune and (args.MMPopulation < 1.0 or args.MMPopLimit > 0):
+        print "Stream pruning can't be combined with the MM Boltzmann " + \
+            "population screen, exiting..."
+        quit()
     if args.Renumber is not None:
         settings.RenumberFile = args.Renumber
     if args.OtherNuclei:
@@ -677,6 +736,20 @@ if __name__ == '__main__':
             [int(x) for x in (args.StereoCentres).split(',')]
     if args.GenOnly:
         settings.GenOnly = True
+    if args.SinglePrecision:
+        settings.SinglePrecisionCoords = True
+    if args.NoPrefilter:
+        settings.RMSDPrefilter = False
+    if args.MassWeight:
+        settings.RMSDMassWeight = True
+    if args.StreamPrune:
+        settings.StreamPrune = True
+    if args.BulkTransfer:
+        settings.BulkTransfer = True
+    if args.NoBulkCompress:
+        settings.BulkCompress = False
+    if args.JobArray:
+        settings.JobArray = True
     if args.StrictConfLimit:
         settings.StrictConfLimit = True
     if args.Cluster:
@@ -11,6 +11,15 @@ execution and output interpretation. Called by PyDP4.py.
 import os
 import sys
 import subprocess
+import time
+import re
+
+import numpy
+
+import Conformers
+
+#Number of threads reading Tinker geometry files at the same time
+TinkerReadThreads = 8
 
 
 def SetupTinker(numDS, settings, *args):
@@ -57,27 +66,45 @@ def SetupTinker(numDS, settings, *args):
 
 
 def RunTinker(numDS, settings, *args):
-    #Run Tinker scan for all diastereomeric inputs
+    #Run Tinker scan for all diastereomeric inputs, up to
+    #settings.MaxConcurrentMMJobs at a time
 
-    NCompleted = 0
+    from multiprocessing.pool import ThreadPool
 
+    jobs = []
     for ds in args:
-        print settings.TinkerPath + ds + ' 0 10 20 0.00001 | tee ./' + ds + \
-            '.tout'
-        outp = subprocess.check_output(settings.TinkerPath + ds +
-            ' 0 10 20 0.00001 | tee ./' + ds + '.tout', shell=True)
-        NCompleted = NCompleted + 1
-        print "Tinker job " + str(NCompleted) + " of " + str(numDS) + \
-            " completed."
-
+        jobs.append(ds)
         if settings.Rot5Cycle is True:
-            print settings.TinkerPath + ds + 'rot 0 10 20 0.00001 | tee ./' + \
-                ds + 'rot.tout'
-            outp = subprocess.check_output(settings.TinkerPath + ds +
-                'rot 0 10 20 0.00001 | tee ./' + ds + 'rot.tout', shell=True)
+            jobs.append(ds + 'rot')
+
+    NCompleted = 0
+    pool = ThreadPool(max(1, min(settings.MaxConcurrentMMJobs, len(jobs))))
+    try:
+        for job, walltime in pool.imap_unordered(
+                lambda job: RunTinkerJob(job, settings), jobs):
             NCompleted = NCompleted + 1
-            print "Tinker job " + str(NCompleted) + " of " + str(numDS*2) + \
-                " completed."
+            print "Tinker job " + str(NCompleted) + " of " + str(len(jobs)) + \
+                " completed (" + job + ", " + format(walltime, ".1f") + " s)."
+    finally:
+        pool.close()
+        pool.join()
+
+
+#Runs a single scan with its output streamed to <job>.tout, returns the job
+#name and its wall time
+def RunTinkerJob(job, settings):
+
+    cmd = settings.TinkerPath + job + ' 0 10 20 0.00001'
+    print cmd + ' > ./' + job + '.tout'
+
+    start = time.time()
+    outfile = open(job + '.tout', 'w')
+    ret = subprocess.call(cmd, shell=True, stdout=outfile)
+    outfile.close()
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+
+    return job, time.time() - start
 
 
 #Reads the relevant tinker geometry files
@@ -132,33 +159,89 @@ def ReadTinker(TinkerOutput, settings):
         for num in RotFileNums:
             Files.append(TinkerOutput + 'rot.' + num.zfill(3))
 
-    conformers = []
-    conformer = 0
-    atoms = []
-
-    for f in Files:
-        conformers.append([])
-
-        atom = 0
-        infile = open(f, 'r')
-        inp = infile.readlines()
-
-        for line in inp[1:]:
-            data = line.split(' ')
-            data = filter(None, data)
-            if conformer == 0:
-                atoms.append(GetTinkerSymbol(int(data[5])))  # Add atom symbol
-            conformers[conformer].append([])                # Add new atom
-            conformers[conformer][atom].append(data[0])     # add atom number
-            conformers[conformer][atom].append(data[2])     # add X
-            conformers[conformer][atom].append(data[3])     # add Y
-            conformers[conformer][atom].append(data[4])     # add Z
-            atom = atom + 1     # Move to the next atom
-
-        infile.close()
-        conformer = conformer + 1   # Move to the next conformer
-
-    return atoms, conformers, charge
+    #Atom symbols and the coordinate columns from the first conformer, the
+    #geometries are read by the ensemble when they are needed
+    types, Layout = ReadTinkerLayout(Files[0])
+    atoms = [GetTinkerSymbol(t) for t in types]
+
+    def loader(indices):
+        return ReadTinkerGeometries([Files[i] for i in indices], Layout)
+
+    #Tinker energies are in kcal/mol, ensembles keep them in kJ/mol
+    ensemble = Conformers.LazyEnsemble(atoms, loader, range(len(Files)),
+                                       charge, [4.184*E for E in AcceptedEs],
+                                       Conformers.CoordType(settings))
+
+    return atoms, ensemble, charge
+
+
+#Reads the atom types from a Tinker geometry file, and the columns of the
+#right aligned coordinate fields in each atom line, from the end of the
+#atom name to the end of z
+def ReadTinkerLayout(f):
+
+    infile = open(f, 'r')
+    inp = infile.readlines()
+    infile.close()
+
+    types = []
+    Layout = []
+    for line in inp[1:]:
+        fields = list(re.finditer(r'\S+', line))
+        types.append(int(fields[5].group()))
+        Layout.append((fields[1].end(), fields[4].end()))
+
+    return types, Layout
+
+
+"""
+Reads the coordinates of a list of Tinker geometry files into one
+(len(Files), natoms, 3) array. The files are read by a pool of threads.
+All conformers of a scan are written with the same layout, so the
+coordinates are cut out of the atom lines at the columns found in the first
+file and converted in one go.
+"""
+def ReadTinkerGeometries(Files, Layout):
+
+    from multiprocessing.pool import ThreadPool
+
+    coords = numpy.empty((len(Files), len(Layout), 3))
+
+    def read(i):
+        coords[i] = ReadTinkerCoords(Files[i], Layout)
+
+    if len(Files) < 2:
+        map(read, range(len(Files)))
+        return coords
+
+    pool = ThreadPool(min(TinkerReadThreads, len(Files)))
+    try:
+        pool.map(read, range(len(Files)))
+    finally:
+        pool.close()
+        pool.join()
+
+    return coords
+
+
+def ReadTinkerCoords(f, Layout):
+
+    infile = open(f, 'r')
+    inp = infile.read().splitlines()[1:]
+    infile.close()
+
+    #Every z field has to end where the layout says
+    fields = [line[start:end] for line, (start, end) in zip(inp, Layout)
+              if line[end:end+1].strip() == '']
+    if len(fields) == len(Layout):
+        xyz = numpy.fromstring(' '.join(fields), sep=' ')
+        if xyz.size == 3*len(Layout):
+            return xyz.reshape(-1, 3)
+
+    #Lines that do not follow the layout are split into fields
+    print "Unexpected layout in " + f + ", reading it field by field"
+    return numpy.array([[float(x) for x in line.split()[2:5]]
+                        for line in inp[:len(Layout)]])
 
 
 # Get energies of conformers from tinker output file
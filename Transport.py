@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:20:07 2026
+
+@author: ke291
+
+Connections to the clusters the DFT jobs run on. All remote commands and
+file transfers of Gaussian.py, NWChem.py and JobScheduler.py go through a
+transport from GetTransport, which keeps one authenticated ssh connection
+per host open for the whole run. LocalTransport runs the same operations in
+a local folder, for testing without a cluster.
+"""
+
+import atexit
+import glob
+import os
+import pipes
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+#Seconds the shared ssh connection stays open after its last use
+SSHPersist = 600
+
+#Open transports by host
+Transports = {}
+
+#Shell function that stands in for sbatch in LocalTransport commands
+LocalSbatch = 'sbatch() { ' + pipes.quote(sys.executable) + ' ' +\
+    pipes.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'JobScheduler.py')) + ' sbatch "$@"; }; '
+
+
+"""
+Returns the transport to host, made on the first call for every host.
+If settings.LocalRemoteDir is set, the transport is a LocalTransport in
+the host subfolder of it.
+"""
+def GetTransport(host, settings):
+
+    if host not in Transports:
+        if settings.LocalRemoteDir != '':
+            Transports[host] = LocalTransport(
+                os.path.join(settings.LocalRemoteDir, host))
+        else:
+            Transports[host] = SSHTransport(host)
+
+    return Transports[host]
+
+
+#Closes all open transports, registered to run at exit
+def CloseTransports():
+
+    for transport in Transports.values():
+        transport.Close()
+    Transports.clear()
+
+atexit.register(CloseTransports)
+
+
+class ArchiveTransfers:
+    """
+    Bulk transfers as one tar stream, shared by the transports. The stream
+    goes through a single command on the host, started by Open, so any
+    number of files costs one round trip. Transports provide
+    Open(command, stdin, stdout), which starts command on the host and
+    returns the Popen object.
+    """
+
+    #Packs local files into remotedir on the host, which is made if needed
+    def PutArchive(self, files, remotedir, compress=True):
+
+        z = 'z' if compress else ''
+        proc = self.Open('mkdir -p ' + remotedir + ' && tar -x' + z +
+                         'f - -C ' + remotedir, subprocess.PIPE, None)
+        archive = tarfile.open(fileobj=proc.stdin,
+                               mode='w|' + ('gz' if compress else ''))
+        for f in files:
+            archive.add(f, arcname=os.path.basename(f))
+        archive.close()
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, 'tar upload')
+
+    """
+    Fetches the files in remotedir on the host that match the shell
+    patterns into localdir. With resume, files that are already in localdir
+    with the same size are left out of the stream, so an interrupted
+    download is picked up where it stopped. Returns the names of the
+    fetched files.
+    """
+    def GetArchive(self, patterns, remotedir, localdir, compress=True,
+                   resume=True):
+
+        z = 'z' if compress else ''
+        Have = []
+        if resume:
+            for pattern in patterns:
+                for f in glob.glob(os.path.join(localdir, pattern)):
+                    Have.append(pipes.quote(os.path.basename(f) + ':' +
+                                            str(os.path.getsize(f))))
+        skip = ''
+        if len(Have) > 0:
+            skip = 'case "$f:$(wc -c < "$f" | tr -d \' \')" in ' +\
+                '|'.join(Have) + ') continue;; esac; '
+        proc = self.Open('cd ' + remotedir + ' && for f in ' +
+                         ' '.join(patterns) + '; do [ -f "$f" ] || continue; ' +
+                         skip + 'echo "$f"; done | tar -c' + z + 'f - -T -',
+                         None, subprocess.PIPE)
+        archive = tarfile.open(fileobj=proc.stdout,
+                               mode='r|' + ('gz' if compress else ''))
+        fetched = []
+        for member in archive:
+            archive.extract(member, localdir)
+            fetched.append(member.name)
+        archive.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, 'tar download')
+
+        return fetched
+
+
+class SSHTransport(ArchiveTransfers):
+    """
+    Runs commands and copies files over an OpenSSH ControlMaster
+    connection. The first ssh or scp call authenticates and leaves a master
+    connection behind a socket, all later calls are multiplexed over it
+    without a new handshake. Commands run in the remote home folder, as
+    with plain ssh.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.ControlPath = os.path.join(tempfile.gettempdir(),
+                                        'pydp4-ssh-%r@%h:%p')
+        self.options = ['-o', 'ControlMaster=auto',
+                        '-o', 'ControlPath=' + self.ControlPath,
+                        '-o', 'ControlPersist=' + str(SSHPersist)]
+
+    #Runs a shell command on the host and returns its output. If check is
+    #set, a failure raises CalledProcessError, otherwise the output
+    #includes stderr and failures are ignored
+    def Run(self, command, check=True):
+        return RunCommand(['ssh'] + self.options + [self.host, command], check)
+
+    #Copies local files into a folder on the host
+    def Put(self, files, remotedir):
+        RunCommand(['scp', '-q'] + self.options + list(files) +
+                   [self.host + ':' + remotedir], True)
+
+    #Copies remote files, which can be shell patterns, into a local folder
+    def Get(self, remotefiles, localdir):
+        RunCommand(['scp', '-q'] + self.options +
+                   [self.host + ':' + f for f in remotefiles] + [localdir],
+                   True)
+
+    def Open(self, command, stdin, stdout):
+        return subprocess.Popen(['ssh'] + self.options + [self.host, command],
+                                stdin=stdin, stdout=stdout)
+
+    def Close(self):
+        subprocess.call(['ssh'] + self.options + ['-O', 'exit', self.host],
+                        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+
+class LocalTransport(ArchiveTransfers):
+    """
+    Stand-in for a cluster host that runs the commands with sh in a local
+    folder, which also serves as the home folder, so that ~ and relative
+    paths in commands and transfers resolve inside it. sbatch is replaced
+    by JobScheduler.LocalSbatch, which runs slurm scripts and job arrays as
+    local processes.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.env = dict(os.environ)
+        self.env['HOME'] = self.root
+
+    def Run(self, command, check=True):
+
+        cmd = ['sh', '-c', LocalSbatch + command]
+        if check:
+            return subprocess.check_output(cmd, cwd=self.root, env=self.env)
+        return subprocess.Popen(cmd, cwd=self.root, env=self.env,
+                                stderr=subprocess.STDOUT,
+                                stdout=subprocess.PIPE).communicate()[0]
+
+    def Put(self, files, remotedir):
+        for f in files:
+            shutil.copy(f, self.LocalPath(remotedir))
+
+    def Get(self, remotefiles, localdir):
+        for pattern in remotefiles:
+            for f in glob.glob(self.LocalPath(pattern)):
+                shutil.copy(f, localdir)
+
+    def Open(self, command, stdin, stdout):
+        return subprocess.Popen(['sh', '-c', LocalSbatch + command],
+                                cwd=self.root,
+                                env=self.env, stdin=stdin, stdout=stdout)
+
+    def Close(self):
+        pass
+
+    #Local path of a path on the stand-in host
+    def LocalPath(self, path):
+        if path.startswith('~'):
+            path = path[1:].lstrip('/')
+        return os.path.join(self.root, path)
+
+
+#Runs a command given as an argument list, see SSHTransport.Run for check
+def RunCommand(cmd, check):
+
+    if check:
+        return subprocess.check_output(cmd)
+
+    return subprocess.Popen(cmd, stderr=subprocess.STDOUT,
+                            stdout=subprocess.PIPE).communicate()[0]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of ConfPrune.StreamPruner on synthetic ensembles. Run from the
+repository folder with python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyximport
+pyximport.install()
+import ConfPrune
+
+Atoms = ['C', 'C', 'C', 'O', 'N', 'C', 'H', 'H']
+
+
+#Conformers scattered around a few basins, with random energies
+def MakeEnsemble(nconfs, seed):
+
+    rng = numpy.random.RandomState(seed)
+    basins = rng.rand(5, len(Atoms), 3)*3
+    coords = basins[rng.randint(0, len(basins), nconfs)] + \
+        rng.randn(nconfs, len(Atoms), 3)*0.5
+    energies = rng.rand(nconfs)*20
+
+    return coords, energies
+
+
+#Conformers in the text form read by ConfPrune, [[label, x, y, z], ...]
+def TextConformers(coords):
+    return [[['1'] + list(a) for a in conf] for conf in coords]
+
+
+class StreamPrunerTests(unittest.TestCase):
+
+    cutoff = 1.0
+
+    def Prune(self, coords, energies, order):
+        pruner = ConfPrune.StreamPruner(Atoms, self.cutoff)
+        pruner.Feed((energies[c], coords[c]) for c in order)
+        return pruner.Ensemble()
+
+    #No two kept conformers may be within the cutoff, whatever the order of
+    #the stream
+    def test_unordered_stream(self):
+
+        for seed in range(5):
+            coords, energies = MakeEnsemble(200, seed)
+            rng = numpy.random.RandomState(seed)
+            order = numpy.argsort(energies)
+            #Two streams in ascending energy, one after the other, as the
+            #main and Rot5Cycle outputs, and a shuffled stream
+            split = rng.rand(len(order)) < 0.5
+            for stream in [numpy.r_[order[split], order[~split]],
+                           rng.permutation(len(order))]:
+                kept = self.Prune(coords, energies, stream)
+                RMSDs = ConfPrune.RMSDMatrix(TextConformers(kept.coords),
+                                             Atoms)
+                self.assertTrue(len(kept) > 1)
+                self.assertTrue((RMSDs.data >= self.cutoff).all())
+
+    #In ascending energy the kept set is that of LeaderPrune
+    def test_ordered_stream(self):
+
+        coords, energies = MakeEnsemble(200, 0)
+        order = numpy.argsort(energies)
+        kept = self.Prune(coords, energies, order)
+        leaders = ConfPrune.LeaderPrune(TextConformers(coords[order]), Atoms,
+                                        self.cutoff)
+
+        self.assertTrue(numpy.allclose(kept.coords,
+                                       [[a[1:] for a in conf]
+                                        for conf in leaders]))
+
+
+if __name__ == '__main__':
+    unittest.main()